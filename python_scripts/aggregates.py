@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+import os
+import json
+import shutil
+import pandas as pd
+
+import ingest
+import metrics
+import profiling
+import pump
+import schema
+import sketches
+import workbooks
+
+# Per-subject aggregates kept between runs, so adding or replacing a
+# workbook only recomputes that subject:
+#
+#   <store_dir>/manifest.json           {settings, files: {file: {size, mtime_ns, sha1}}}
+#   <store_dir>/<file stem>/<table>.parquet
+#
+# with the tables
+#
+#   daily_metrics   metrics.daily_metrics of the subject's CGM readings
+#   coverage        the subject's metrics.cohort_summary row
+#   range_counts    the subject's metrics.range_counts row
+#   daily_totals    pump.daily_totals of the subject's Bolus records
+#   box_stats       pump.box_stats_table of the subject's Bolus records:
+#                   box statistics of the positive doses and carb inputs
+#   sketches        sketches.sketch_table of the subject's quantile
+#                   sketches (bolus doses, carb inputs, daily totals and
+#                   daily metrics), for make_all.py --sketches
+#
+# A workbook is recomputed when it is new or its content hash changed (the
+# hash is only taken when size or mtime differ, as for the sheet cache).
+# Changing any of the settings below recomputes every subject.
+
+SHEETS = {'CGM': ['mg/dl'], 'Bolus': ['normal', 'carbInput']}
+TABLES = ['daily_metrics', 'coverage', 'range_counts', 'daily_totals', 'box_stats', 'sketches']
+INDEXED_TABLES = ['coverage', 'range_counts']
+COVERAGE_COLUMNS = ['readings', 'cgm_days', 'first_reading', 'last_reading',
+                    'bolus_events', 'pump_days', 'bolus_count', 'carb_count',
+                    'first_bolus', 'last_bolus']
+VERSION = 2
+
+
+def settings():
+    # Everything the stored aggregates depend on besides the workbooks
+    return json.loads(json.dumps({'version': VERSION,
+                                  'date_format': schema.DATE_FORMAT,
+                                  'min_daily_readings': metrics.MIN_DAILY_READINGS,
+                                  'readings_per_day': metrics.READINGS_PER_DAY,
+                                  'target_range': metrics.TARGET_RANGE,
+                                  'range_edges': metrics.RANGE_EDGES,
+                                  'whisker_iqr': pump.WHISKER_IQR,
+                                  'sketch_alpha': sketches.ALPHA,
+                                  'sketch_version': sketches.VERSION}))
+
+
+def subject_aggregates(cbg_df, bolus_df):
+    # The stored tables of one subject; cbg_df or bolus_df may be None
+    tables = {}
+    if cbg_df is not None and len(cbg_df):
+        tables['daily_metrics'] = metrics.daily_metrics(cbg_df)
+        tables['range_counts'] = metrics.range_counts(cbg_df)
+    else:
+        cbg_df = None
+    if bolus_df is not None and len(bolus_df):
+        tables['daily_totals'] = pump.daily_totals(bolus_df)
+        tables['box_stats'] = pump.box_stats_table(bolus_df)
+    else:
+        bolus_df = None
+    if cbg_df is not None or bolus_df is not None:
+        tables['coverage'] = metrics.cohort_summary(cbg_df, bolus_df)
+        tables['sketches'] = sketch_table(tables, bolus_df)
+    return tables
+
+
+def sketch_table(tables, bolus_df=None):
+    # The sketches table of one subject's other tables and Bolus records
+    return sketches.sketch_table(sketches.subject_sketches(dict(tables, bolus=bolus_df)))
+
+
+def merge(per_subject):
+    # Cohort tables from a list of subject_aggregates results, in the order
+    # the cohort-wide functions would produce them
+    merged = {}
+    for name in TABLES:
+        frames = [tables[name] for tables in per_subject if name in tables]
+        merged[name] = pd.concat(frames) if frames else pd.DataFrame()
+
+    coverage = merged['coverage'].reindex(columns=COVERAGE_COLUMNS)
+    has_cgm = coverage['readings'].notna()
+    coverage = pd.concat([coverage[has_cgm], coverage[~has_cgm]])
+    coverage.index.name = 'subject'
+    merged['coverage'] = coverage
+    merged['range_counts'] = merged['range_counts'].sort_index()
+    for name in ['daily_metrics', 'daily_totals', 'box_stats', 'sketches']:
+        merged[name] = merged[name].reset_index(drop=True)
+    return merged
+
+
+class AggregateStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.enabled = workbooks.HAVE_PARQUET and store_dir not in ('', 'off')
+        self.recomputed = []
+        self.reused = []
+
+    def _manifest_file(self):
+        return os.path.join(self.store_dir, 'manifest.json')
+
+    def _entry_dir(self, file):
+        return os.path.join(self.store_dir, os.path.splitext(file)[0])
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_file()) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('settings') != settings():
+            return {}
+        return manifest.get('files', {})
+
+    def _write_manifest(self, files):
+        tmp = self._manifest_file() + '.%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump({'settings': settings(), 'files': files}, f, indent=1)
+        os.replace(tmp, self._manifest_file())
+
+    def _fingerprint(self, path, entry=None):
+        # Fingerprint of the workbook at path, and whether it matches entry
+        st = os.stat(path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry, True
+        sha1 = workbooks.file_sha1(path)
+        fingerprint = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1}
+        return fingerprint, entry is not None and entry['sha1'] == sha1
+
+    def _read_tables(self, file):
+        entry_dir = self._entry_dir(file)
+        tables = {}
+        for name in TABLES:
+            table_file = os.path.join(entry_dir, name + '.parquet')
+            if not os.path.exists(table_file):
+                continue
+            df = pd.read_parquet(table_file)
+            if name in INDEXED_TABLES:
+                df = df.set_index('subject')
+            tables[name] = df
+        return tables
+
+    def _write_tables(self, file, tables):
+        entry_dir = self._entry_dir(file)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(entry_dir)
+        for name, df in tables.items():
+            if name in INDEXED_TABLES:
+                df = df.reset_index()
+            df.to_parquet(os.path.join(entry_dir, name + '.parquet'), index=False)
+
+    def update(self, dataset_path, workers=1):
+        # Brings the store up to date with the workbooks in dataset_path and
+        # returns the merged cohort tables (see merge)
+        files = os.listdir(dataset_path)
+        manifest = self._read_manifest() if self.enabled else {}
+        fingerprints = {}
+        stale = []
+        for file in files:
+            path = os.path.join(dataset_path, file)
+            if not self.enabled or not os.path.isfile(path):
+                stale.append(file)
+                continue
+            fingerprints[file], unchanged = self._fingerprint(path, manifest.get(file))
+            if not unchanged or not os.path.isdir(self._entry_dir(file)):
+                stale.append(file)
+
+        computed = {}
+        results = ingest.load_subjects(dataset_path, stale, SHEETS, workers)
+        for file, (frames, counts) in zip(stale, results):
+            with profiling.stage('aggregate', schema.subject_id(file)):
+                computed[file] = subject_aggregates(frames['CGM'], frames['Bolus'])
+
+        self.recomputed = stale
+        self.reused = [file for file in files if file not in computed]
+        if self.enabled:
+            os.makedirs(self.store_dir, exist_ok=True)
+            for file in set(manifest) - set(files):
+                shutil.rmtree(self._entry_dir(file), ignore_errors=True)
+            for file in stale:
+                if file in fingerprints:
+                    self._write_tables(file, computed[file])
+            self._write_manifest(fingerprints)
+
+        per_subject = [computed[file] if file in computed else self._read_tables(file) for file in files]
+        return merge(per_subject)
+
+    def summary(self):
+        return "Aggregate store {}: {} workbooks recomputed, {} reused".format(
+            self.store_dir, len(self.recomputed), len(self.reused))
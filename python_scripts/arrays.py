@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+import ingest
+import profiling
+import schema
+
+# Fixed-width per-subject column arrays of the CGM, Bolus and Basal tables,
+# written once from the workbooks and memory-mapped by every later run, so
+# opening the cohort only reads meta.json and the OS page cache shares the
+# data between processes and runs:
+#
+#   <array_dir>/meta.json                   {version, columns, missing, subjects: {subject: {sheet: rows}}}
+#   <array_dir>/<subject>/<sheet>.<column>.npy
+#
+# Each .npy file carries its own small header (dtype, shape). Columns are
+# epoch int64 for every sheet, mg/dl uint16 with GLUCOSE_MISSING for missing
+# readings, and the pump columns float64 (NaN when missing): some workbooks
+# hold doses computed to full double precision, which float32 would round,
+# and the pump streams are a small fraction of the bytes.
+
+VERSION = 1
+COLUMNS = {'CGM': {'epoch': 'int64', 'mg/dl': 'uint16'},
+           'Bolus': {'epoch': 'int64', 'normal': 'float64', 'carbInput': 'float64',
+                     'insulinCarbRatio': 'float64'},
+           'Basal': {'epoch': 'int64', 'rate': 'float64'}}
+GLUCOSE_MISSING = 0
+# meta.json keys that mark a directory as an earlier export
+META_KEYS = ('version', 'columns', 'subjects')
+
+# ingest sheet spec covering every exported column
+SHEETS = {sheet_name: [c for c in columns if c != 'epoch'] for sheet_name, columns in COLUMNS.items()}
+
+
+def _file_name(sheet_name, column):
+    return '{}.{}.npy'.format(sheet_name, column.replace('/', '_'))
+
+
+def to_array(values, dtype):
+    # Column of a canonical table as its fixed-width array
+    if dtype == 'uint16':
+        return pd.Series(values).to_numpy(dtype=dtype, na_value=GLUCOSE_MISSING)
+    if dtype.startswith('float'):
+        return schema.as_float(values).astype(dtype)
+    return np.asarray(values, dtype=dtype)
+
+
+def check_replaceable(target, keys):
+    # Raises ValueError unless target is missing, an empty directory, or a
+    # directory this module (or grid.py) wrote, i.e. one whose meta.json
+    # holds keys. Anything else a user points -o at is left alone.
+    if not os.path.lexists(target):
+        return
+    if not os.path.isdir(target) or os.path.islink(target):
+        raise ValueError("{} exists and is not a directory".format(target))
+    if not os.listdir(target):
+        return
+    try:
+        with open(os.path.join(target, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    if not isinstance(meta, dict) or not all(key in meta for key in keys):
+        raise ValueError("{} is not empty and holds no meta.json of an earlier export; "
+                         "remove it or choose another directory".format(target))
+
+
+def replace_dir(target, keys, write):
+    # Calls write(directory) on a new directory next to target and moves it
+    # in place of target once write returns, so a failed export leaves
+    # target as it was. target must pass check_replaceable(target, keys).
+    # Returns what write returned.
+    check_replaceable(target, keys)
+    parent, name = os.path.split(os.path.abspath(target))
+    new_dir = tempfile.mkdtemp(prefix='.' + name + '.', dir=parent)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(new_dir, 0o777 & ~umask)
+    try:
+        result = write(new_dir)
+    except BaseException:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        raise
+    if os.path.lexists(target):
+        # A directory cannot be renamed over a non-empty one: move the old
+        # export aside first
+        old_dir = new_dir + '.old'
+        os.replace(target, old_dir)
+        os.replace(new_dir, target)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.replace(new_dir, target)
+    return result
+
+
+def write_arrays(array_dir, tables):
+    # Export canonical cohort tables ({sheet name: table}) as per-subject
+    # arrays, replacing an earlier export in array_dir (see replace_dir)
+    return replace_dir(array_dir, META_KEYS, lambda new_dir: _write_arrays(new_dir, tables))
+
+
+def _write_arrays(array_dir, tables):
+    subjects = {}
+    for sheet_name, columns in COLUMNS.items():
+        df = tables.get(sheet_name)
+        if df is None or 'subject' not in df:
+            continue
+        for subject, subject_df in df.groupby('subject', sort=False):
+            subject_dir = os.path.join(array_dir, str(subject))
+            os.makedirs(subject_dir, exist_ok=True)
+            for column, dtype in columns.items():
+                values = subject_df[column] if column in subject_df else np.full(len(subject_df), np.nan)
+                np.save(os.path.join(subject_dir, _file_name(sheet_name, column)), to_array(values, dtype))
+            subjects.setdefault(str(subject), {})[sheet_name] = len(subject_df)
+
+    meta = {'version': VERSION, 'columns': COLUMNS, 'missing': {'mg/dl': GLUCOSE_MISSING},
+            'subjects': subjects}
+    with open(os.path.join(array_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+class ArrayStore:
+    # Read side of an array directory. Nothing but meta.json is read until
+    # a stream is requested, and streams are np.memmap views of the files.
+
+    def __init__(self, array_dir):
+        self.array_dir = array_dir
+        with open(os.path.join(array_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != VERSION:
+            raise ValueError("{} holds arrays of version {}, expected {}".format(
+                array_dir, self.meta.get('version'), VERSION))
+
+    def subjects(self):
+        # In the order of the exported tables, i.e. the dataset's os.listdir
+        # order for an export of a dataset, as for ingest.load_cohort
+        return [int(subject) for subject in self.meta['subjects']]
+
+    def rows(self, subject, sheet_name):
+        return self.meta['subjects'].get(str(subject), {}).get(sheet_name, 0)
+
+    def stream(self, subject, sheet_name, start=None, stop=None):
+        # {column: read-only np.memmap} of one subject's sheet, rows start to
+        # stop; empty if the subject has no such records
+        if not self.rows(subject, sheet_name):
+            return {}
+        subject_dir = os.path.join(self.array_dir, str(subject))
+        return {column: np.load(os.path.join(subject_dir, _file_name(sheet_name, column)), mmap_mode='r')[start:stop]
+                for column in self.meta['columns'][sheet_name]}
+
+    def table(self, subject, sheet_name, start=None, stop=None):
+        # One subject's canonical table (see schema.py), or rows start to
+        # stop of it, built from its arrays
+        stream = self.stream(subject, sheet_name, start, stop)
+        if not stream:
+            return None
+        epoch = np.asarray(stream['epoch'])
+        table = {'subject': np.full(len(epoch), subject, dtype=schema.SUBJECT_DTYPE), 'epoch': epoch}
+        table.update(schema.calendar_fields(epoch))
+        for column in self.meta['columns'][sheet_name]:
+            if column == 'epoch':
+                continue
+            values = np.asarray(stream[column])
+            if column in self.meta['missing']:
+                missing = values == self.meta['missing'][column]
+                values = pd.array(values, dtype=schema.VALUE_DTYPES[column])
+                values[missing] = pd.NA
+            table[column] = values
+        return pd.DataFrame(table)
+
+    def chunks(self, subject, sheet_name, rows):
+        # table() of the subject in pieces of at most rows rows, so only one
+        # piece is ever read into memory
+        total = self.rows(subject, sheet_name)
+        for start in range(0, total, rows):
+            yield self.table(subject, sheet_name, start, start + rows)
+
+    def cohort(self, sheets):
+        # CohortBuilder over every subject, like ingest.load_cohort; sheets
+        # maps sheet names to the columns wanted
+        cohort = ingest.CohortBuilder(sheets)
+        for subject in self.subjects():
+            frames = {}
+            for sheet_name, columns in sheets.items():
+                df = self.table(subject, sheet_name)
+                frames[sheet_name] = None if df is None else df[['subject', 'epoch'] + schema.CALENDAR_COLUMNS + columns]
+            cohort.add(subject, frames)
+        return cohort
+
+
+def export(dataset_path, array_dir, workers=1):
+    check_replaceable(array_dir, META_KEYS)
+    cohort = profiling.run('load cohort', ingest.load_cohort, dataset_path, SHEETS, workers)
+    print(cohort.summary())
+    with profiling.stage('build tables') as record:
+        tables = {sheet_name: cohort.build(sheet_name) for sheet_name in COLUMNS}
+        record['rows'] = sum(len(df) for df in tables.values())
+    with profiling.stage('write arrays'):
+        meta = write_arrays(array_dir, tables)
+    print("Wrote arrays of {} subjects to {}".format(len(meta['subjects']), array_dir))
+
+
+def main(argv):
+    datadir_path = ''
+    array_dir = ''
+    workers = 1
+    profile_path = None
+
+    usage = 'arrays.py -d <path to dataset directory> -o <path to array directory> [-w <number of workers>] [--profile <trace file>]'
+    if (len(argv) < 4):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:o:w:",["datasetDir=","arrayDir=","workers=","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t arrays.py -d ../dataset/ -o ../arrays/')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-o", "--arrayDir"):
+            array_dir = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    print('Path to dataset directory is ' + datadir_path)
+    print('Path to array directory is ' + array_dir)
+    if profile_path:
+        profiling.start(profile_path, ['arrays.py'] + argv)
+    export(datadir_path, array_dir, workers)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+import json
+import platform
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import profiling
+import synthetic
+
+# Scaling benchmark: generates synthetic cohorts (see synthetic.py) of each
+# size and times every setup_tables, aggregation and render function on
+# them, recording wall time, peak RSS and rows per stage:
+#
+#   {"python", "pandas", "numpy", "cpus", "days", "templates",
+#    "sizes": {subjects: {"generate_seconds", "stages": [{"group", "stage",
+#                         "seconds", "peak_rss_mb", "rows"}]}}}
+#
+# Each size runs in a fresh process with the sheet cache off, so every run
+# decodes the workbooks. Peak RSS is the high-water mark of the stage alone
+# where the kernel can reset it (Linux), otherwise that of the process so
+# far. Comparing against the results of an earlier run reports stages that
+# got slower or bigger by more than TOLERANCE.
+
+SIZES = [10, 54, 500, 5000]
+DAYS = 60
+TEMPLATES = 54
+TOLERANCE = 1.25
+MIN_SECONDS = 0.05
+
+
+class StageRecorder:
+    def __init__(self):
+        self.stages = []
+
+    def run(self, group, name, func, *args):
+        profiling.reset_peak_rss()
+        start = perf_counter()
+        result = func(*args)
+        self.stages.append({'group': group, 'stage': name,
+                            'seconds': perf_counter() - start,
+                            'peak_rss_mb': profiling.peak_rss_mb(),
+                            'rows': profiling.count_rows(result)})
+        return result
+
+
+def run_stages(dataset_path, figure_dir, cache=False):
+    # Every stage on one dataset; meant for a fresh process
+    if not cache:
+        os.environ['DIATREND_CACHE_DIR'] = 'off'
+    import render
+    render.use_headless_backend()
+    import figure1, figure2, figure3, figure4, figure5
+    import make_all
+    import metrics
+    import pump
+
+    figure_dir = os.path.join(figure_dir, '')
+    os.makedirs(figure_dir, exist_ok=True)
+    subject_path = os.path.join(dataset_path, 'Subject1.xlsx')
+    recorder = StageRecorder()
+
+    subject_tables = recorder.run('setup', 'figure1.setup_tables', figure1.setup_tables, subject_path)
+    recorder.run('setup', 'figure2.setup_tables', figure2.setup_tables, dataset_path)
+    recorder.run('setup', 'figure3.setup_tables', figure3.setup_tables, dataset_path)
+    recorder.run('setup', 'figure4.setup_tables', figure4.setup_tables, dataset_path)
+    recorder.run('setup', 'figure5.setup_tables', figure5.setup_tables, dataset_path)
+    cgm_df, bolus_df, basal_df = recorder.run('setup', 'make_all.load_dataset', make_all.load_dataset, dataset_path)
+
+    days_collected = recorder.run('aggregation', 'figure2.days_collected_table', figure2.days_collected_table,
+                                  cgm_df, bolus_df)
+    pump_counts = recorder.run('aggregation', 'figure3.pump_counts', figure3.pump_counts, bolus_df)
+    daily = recorder.run('aggregation', 'metrics.daily_metrics', metrics.daily_metrics, cgm_df)
+    ranges = recorder.run('aggregation', 'metrics.time_in_ranges', metrics.time_in_ranges, cgm_df)
+    totals = recorder.run('aggregation', 'pump.daily_totals', pump.daily_totals, bolus_df)
+    bolus_stats, carbs_stats = recorder.run('aggregation', 'figure5.boxplot_stats', figure5.boxplot_stats, bolus_df)
+
+    jobs = [('figure2.make_figure', figure2.make_figure, (days_collected, figure_dir + 'figure2.pdf')),
+            ('figure3.plot_figure', figure3.plot_figure, (pump_counts, figure_dir + 'figure3.pdf')),
+            ('figure4.plot_histograms', figure4.plot_histograms, (daily[['mean', 'cov', 'tir']], figure_dir)),
+            ('figure4.plot_figure', figure4.plot_figure, (ranges, figure_dir)),
+            ('figure5.plot_histograms', figure5.plot_histograms, (totals[['bolus', 'carbs']], figure_dir)),
+            ('figure5.plot_boxplots', figure5.plot_boxplots, (bolus_stats, carbs_stats, figure_dir)),
+            ('figure1.make_figure', figure1.make_figure, subject_tables + (figure_dir + 'figure1.pdf',))]
+    for job in jobs:
+        recorder.run('render', job[0], render.render_job, job)
+    return recorder.stages
+
+
+def dataset_for(bench_dir, subjects, days, templates):
+    # Path of the synthetic cohort of that size, generated unless an earlier
+    # run left it there, and the seconds generating it took
+    dataset_path = os.path.join(bench_dir, 'subjects{}_days{}'.format(subjects, days))
+    marker = dataset_path + '.json'
+    params = {'subjects': subjects, 'days': days, 'templates': templates}
+    try:
+        with open(marker) as f:
+            if json.load(f) == params:
+                return dataset_path, 0.0
+    except (OSError, ValueError):
+        pass
+
+    start = perf_counter()
+    synthetic.generate(dataset_path, subjects, days, templates)
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return dataset_path, perf_counter() - start
+
+
+def benchmark(bench_dir, sizes=SIZES, days=DAYS, templates=TEMPLATES, cache=False):
+    results = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+               'cpus': os.cpu_count(), 'days': days, 'templates': templates, 'sizes': {}}
+    for subjects in sizes:
+        dataset_path, generate_seconds = dataset_for(bench_dir, subjects, days, templates)
+        figure_dir = os.path.join(bench_dir, 'figures{}'.format(subjects))
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            stages = pool.submit(run_stages, dataset_path, figure_dir, cache).result()
+        results['sizes'][str(subjects)] = {'generate_seconds': generate_seconds, 'stages': stages}
+        print(summary(subjects, stages))
+    return results
+
+
+def summary(subjects, stages):
+    width = max(len(stage['stage']) for stage in stages)
+    lines = ["{} subjects".format(subjects)]
+    for stage in stages:
+        lines.append("  {:<11} {:<{}}  {:>8.2f} s  {:>8.1f} MB  {:>10}".format(
+            stage['group'], stage['stage'], width, stage['seconds'], stage['peak_rss_mb'],
+            '' if stage['rows'] is None else stage['rows']))
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Lines describing the stages that took more than tolerance times their
+    # baseline seconds (and MIN_SECONDS more) or peak RSS
+    regressions = []
+    for subjects, size in results['sizes'].items():
+        if subjects not in baseline['sizes']:
+            continue
+        before = {stage['stage']: stage for stage in baseline['sizes'][subjects]['stages']}
+        for stage in size['stages']:
+            old = before.get(stage['stage'])
+            if old is None:
+                continue
+            if stage['seconds'] > old['seconds'] * tolerance and stage['seconds'] - old['seconds'] > MIN_SECONDS:
+                regressions.append("{} subjects {}: {:.2f} s, was {:.2f} s".format(
+                    subjects, stage['stage'], stage['seconds'], old['seconds']))
+            if stage['peak_rss_mb'] > old['peak_rss_mb'] * tolerance:
+                regressions.append("{} subjects {}: {:.1f} MB, was {:.1f} MB".format(
+                    subjects, stage['stage'], stage['peak_rss_mb'], old['peak_rss_mb']))
+    return regressions
+
+
+def main(argv):
+    bench_dir = ''
+    sizes = SIZES
+    days = DAYS
+    templates = TEMPLATES
+    results_path = None
+    baseline_path = None
+    cache = False
+
+    usage = 'benchmark.py -o <benchmark directory> [-n <subject counts, comma separated>] [-d <days per subject>] [-t <distinct workbooks>] [-j <results file>] [-b <baseline results file>] [--cache]'
+    if (len(argv) < 2):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"ho:n:d:t:j:b:",["benchDir=","sizes=","days=","templates=","results=","baseline=","cache"])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t benchmark.py -o ../benchmark/ -n 10,54 -b ../benchmark/baseline.json')
+            sys.exit()
+        elif opt in ("-o", "--benchDir"):
+            bench_dir = arg
+        elif opt in ("-n", "--sizes"):
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt in ("-d", "--days"):
+            days = int(arg)
+        elif opt in ("-t", "--templates"):
+            templates = int(arg)
+        elif opt in ("-j", "--results"):
+            results_path = arg
+        elif opt in ("-b", "--baseline"):
+            baseline_path = arg
+        elif opt == "--cache":
+            cache = True
+        else:
+            print(usage)
+
+    if results_path is None:
+        results_path = os.path.join(bench_dir, 'results.json')
+    results = benchmark(bench_dir, sizes, days, templates, cache)
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("Wrote " + results_path)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print("Regression: " + line)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + baseline_path)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
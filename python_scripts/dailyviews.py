@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+from time import perf_counter
+
+import figure1
+import ingest
+import profiling
+import schema
+import timeindex
+
+# Figure 1's three-panel daily view (see figure1.DailyView) for every day of
+# every subject, drawn on one figure whose artists are updated per page.
+
+
+def subject_days(index, subject):
+    # Day numbers on which the subject has CGM readings
+    span = index.span(subject, 'CGM')
+    if span is None:
+        return []
+    days = range(span[0] // schema.SECONDS_PER_DAY, span[1] // schema.SECONDS_PER_DAY + 1)
+    return [day for day in days if len(index.day(subject, day)['CGM'])]
+
+
+def render_days(index, output, subjects=None, file_format='pdf'):
+    # Render every day with CGM readings of each subject. output ending in
+    # .pdf is written as one multipage PDF, anything else is taken as a
+    # directory for SubjectNN_YYYY-MM-DD.<file_format> files. Returns the
+    # number of pages.
+    from matplotlib.backends.backend_pdf import PdfPages
+    import matplotlib.pyplot as plt
+
+    if subjects is None:
+        subjects = index.subjects()
+    per_day = not output.endswith('.pdf')
+    if per_day:
+        os.makedirs(output, exist_ok=True)
+        pdf = None
+    else:
+        pdf = PdfPages(output)
+
+    view = figure1.DailyView()
+    pages = 0
+    start = perf_counter()
+    for subject in subjects:
+        for day in subject_days(index, subject):
+            with profiling.stage('update page', subject) as record:
+                streams = index.day(subject, day)
+                day_start = day * schema.SECONDS_PER_DAY
+                basal_seed, ratio_seed = figure1.day_seeds(index, subject, day_start)
+                view.update(subject, day, streams['CGM'], streams['Bolus'], streams['Basal'],
+                            basal_seed, ratio_seed)
+                record['rows'] = sum(len(stream) for stream in streams.values())
+            with profiling.stage('save page', subject):
+                if per_day:
+                    date = schema.to_datetime([day_start])[0].date()
+                    view.save(os.path.join(output, 'Subject{}_{}.{}'.format(subject, date, file_format)))
+                else:
+                    view.save(pdf)
+            pages += 1
+    if pdf is not None:
+        pdf.close()
+    plt.close(view.fig)
+
+    elapsed = perf_counter() - start
+    print("{} pages in {:.1f} s ({:.1f} pages/s)".format(pages, elapsed, pages / elapsed if elapsed else 0))
+    return pages
+
+
+def main(argv):
+    datadir_path = ''
+    output = ''
+    subjects = None
+    workers = 1
+    file_format = 'pdf'
+    profile_path = None
+
+    usage = 'dailyviews.py -d <path to dataset directory> -f <path to pdf or output directory> [-s <subject numbers>] [-w <number of workers>] [-t <per-day file format>] [--profile <trace file>]'
+    if (len(argv) < 4):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:f:s:w:t:",["datasetDir=","figurePath=","subjects=","workers=","format=","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t dailyviews.py -d ../dataset/ -f ../Figures/daily_views.pdf -s 31,32')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-f", "--figurePath"):
+            output = arg
+        elif opt in ("-s", "--subjects"):
+            subjects = [int(s) for s in arg.split(',')]
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-t", "--format"):
+            file_format = arg
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    print('Path to dataset directory is ' + datadir_path)
+    print('Path to output is ' + output)
+
+    if profile_path:
+        profiling.start(profile_path, ['dailyviews.py'] + argv)
+    cohort = profiling.run('load cohort', ingest.load_cohort, datadir_path, figure1.SHEETS, workers)
+    print(cohort.summary())
+    with profiling.stage('build time index') as record:
+        tables = {sheet_name: cohort.build(sheet_name) for sheet_name in figure1.SHEETS}
+        index = timeindex.TimeIndex(tables)
+        record['rows'] = sum(len(df) for df in tables.values())
+    profiling.run('render days', render_days, index, output, subjects, file_format)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
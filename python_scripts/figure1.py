@@ -1,226 +1,325 @@
 #!/usr/bin/python
 
 import sys, getopt
+import os
+import numpy as np
 import pandas as pd
-from datetime import timedelta
-import matplotlib.pyplot as plt
-import matplotlib.dates as dates
-import matplotlib.ticker as ticker
-import matplotlib.gridspec as gridspec
-from matplotlib.patches import Patch
-from matplotlib.lines import Line2D
-
-def make_figure(subject_path, figure_path):
-    
-    weekstr = '20'
-    weekday = 'Thursday'
-
-    cgm_df = pd.read_excel(subject_path, index_col=False, sheet_name='CGM')
-    cgm_df.loc[:,'date'] = pd.to_datetime(cgm_df['date'])
-    cgm_df['day'] = cgm_df['date'].dt.strftime('%A')
-    cgm_df['week'] = cgm_df['date'].dt.strftime('%W')
-    cgm_df['time'] = cgm_df['date'].dt.time
-    weekday_df = cgm_df.loc[(cgm_df.day == weekday) & (cgm_df.week == weekstr)].copy()
-    weekday_df.loc[:,'time'] = pd.to_datetime(weekday_df['date'], format='%M:%S.%f') 
-
-    bolus_df = pd.read_excel(subject_path, index_col=False, sheet_name='Bolus')
-    bolus_df.loc[:,'date'] = pd.to_datetime(bolus_df['date'])
-    bolus_df['day'] = bolus_df['date'].dt.strftime('%A')
-    bolus_df['week'] = bolus_df['date'].dt.strftime('%W')
-    bolus_df['time'] = bolus_df['date'].dt.time
-
-    basal_df = pd.read_excel(subject_path, index_col=False, sheet_name='Basal')
-    basal_df.loc[:,'date'] = pd.to_datetime(basal_df['date'])
-    basal_df['day'] = basal_df['date'].dt.strftime('%A')
-    basal_df['week'] = basal_df['date'].dt.strftime('%W')
-    basal_df['time'] = basal_df['date'].dt.time
-
-    fig = plt.figure(figsize=(15, 10))
-    gs = gridspec.GridSpec(nrows=3, ncols=1, height_ratios=[7,7,2])
-    fig.subplots_adjust(hspace=0.5, wspace=0.1)
-
-    ax = fig.add_subplot(gs[0])
-    xmin = min(weekday_df['time'])
-    xmax = max(weekday_df['time'])
-    ymin = int(min(weekday_df['mg/dl'])) - 3
-    ymax = int(max(weekday_df['mg/dl'])) + 3
-
-    bg = ax.plot(weekday_df['time'], weekday_df['mg/dl'], marker='o', color='#652CDF', linestyle='none')
-    ax.plot([xmin, xmax], [180, 180], 'k', linewidth=2, label = 'high')
-    ax.plot([xmin, xmax], [70, 70], 'k', linewidth=2, label = 'low')
-
-    ax.annotate('180', (xmax, 180), fontsize=12)
-    ax.annotate('70', (xmax, 70), fontsize=12)
-
-    ax.set_xlabel("Time of Day", fontsize=18)
-    ax.set_ylabel("Blood Glucose (mg/dL)", fontsize=18)
-
-    ax.set_ylim(0, 400)
-    ax.yaxis.set_minor_locator(ticker.AutoMinorLocator())
-    ax.yaxis.set_major_locator(ticker.MultipleLocator(base=100))
-    ax.yaxis.set_major_formatter(ticker.FormatStrFormatter("%d"))
-
-    h_loc = dates.HourLocator(byhour=range(0,24,3))
-    ax.xaxis.set_minor_locator(dates.HourLocator())
-    ax.xaxis.set_major_locator(h_loc)
-    xfmt = dates.DateFormatter('%l %p')
-    ax.xaxis.set_major_formatter(xfmt)
-    ax.grid(True)
-    ax.tick_params(axis='both', which='major', labelsize=14)
-
-    weekday_bolus = bolus_df.loc[(bolus_df.day == weekday) & (bolus_df.week == weekstr)].copy()
-    weekday_bolus.loc[:,'time'] = pd.to_datetime(weekday_bolus['date'], format='%M:%S.%f') 
-    weekday_bolus = weekday_bolus[weekday_bolus['normal'].notna()]
-
-    ratio_times = []
-    ratio_insulinCarbRatios = []
-    curr = bolus_df.at[295, 'insulinCarbRatio']
-    ratio_times.append(xmin)
-    ratio_insulinCarbRatios.append(bolus_df.at[295, 'insulinCarbRatio'])
-
-    for i in weekday_bolus.iloc[::-1].index:
-        if curr != weekday_bolus.at[i, 'insulinCarbRatio']:
-            curr = weekday_bolus.at[i, 'insulinCarbRatio']
-            ratio_insulinCarbRatios.append(curr)
-            ratio_times.append(weekday_bolus.at[i, 'time'])
-            
-    ratios_df = pd.DataFrame({"time":ratio_times,
-                            "ratio":ratio_insulinCarbRatios})
-
-    weekday_basal = basal_df.loc[(basal_df.day == weekday) & (basal_df.week == weekstr)].copy()
-    weekday_basal.loc[:,'time'] = pd.to_datetime(weekday_basal['date'], format='%M:%S.%f') 
-    weekday_basal['rate'] = weekday_basal['rate'].fillna(0)
-    rates = weekday_basal['rate'].tolist()
-    rates.reverse()
-    rates = [0.3] + rates
-    basal_rates = []
-    for r in rates:
-        basal_rates.append(r)
-        basal_rates.append(r)
-
-    times = weekday_basal['time'].tolist()
-    times.reverse()
-    basal_times = [xmin]
-    for t in times:
-        basal_times.append(t)
-        basal_times.append(t)
-    basal_times.append(xmax)
-    basal_times = pd.to_datetime(basal_times)
-
-    ax_bolus = fig.add_subplot(gs[1])
-    ax_basal = ax_bolus.twinx()
-
-    bolus = ax_bolus.bar(weekday_bolus['time'], weekday_bolus['normal'], color='#B5ACF2', width=0.03)
-    basal = ax_basal.plot(basal_times, basal_rates, color='#F06688', linewidth=2)
-
-    ax_bolus.set_xlabel("Time of Day", fontsize=18)
-    ax_bolus.set_ylabel("Bolus (units)", fontsize=18)
-    ax_basal.set_ylabel("Basal (units)", fontsize=18)
-
-    ax_bolus.set_xlim(xmin - timedelta(hours=1), xmax + timedelta(hours=1))
-    ax_bolus.set_ylim(0, 1.75)
-    h_loc = dates.HourLocator(byhour=range(0,24,3))
-    ax_bolus.xaxis.set_minor_locator(dates.HourLocator())
-    ax_bolus.xaxis.set_major_locator(h_loc)
-    xfmt = dates.DateFormatter('%l %p')
-    ax_bolus.xaxis.set_major_formatter(xfmt)
-    ax_basal.set_ylim(0, 1)
-
-    ax_bolus.grid(True)
-    ax_bolus.tick_params(axis='both', which='major', labelsize=14)
-    ax_basal.tick_params(axis='y', which='major', labelsize=14)
-    ax_bolus.yaxis.set_minor_locator(ticker.AutoMinorLocator())
-    ax_basal.yaxis.set_minor_locator(ticker.AutoMinorLocator())
-    ax_basal.yaxis.set_major_formatter(ticker.FormatStrFormatter("%.2f"))
-
-    bolus_carb_map = dict(zip(list(range(len(weekday_bolus.carbInput))), weekday_bolus.carbInput))
-
-    i = 0
-    for bar in ax_bolus.patches:
-        carb_input = bolus_carb_map[i]
-        i += 1
-        if carb_input > 0:
-            ax_bolus.annotate(format(carb_input, '.0f'),
-                            (bar.get_x() + bar.get_width() / 2, bar.get_height() + 0.2), 
-                            ha='center', va='center', 
-                            bbox=dict(boxstyle="circle", ec='#F0C46E', fc="#F0C46E", pad=0.5),
-                            size=12, xytext=(-0.2, -1.5),
-                            textcoords='offset points')
-
-    ax_ratio = fig.add_subplot(gs[2], sharex=ax_bolus)
-
-    ax_ratio.set_xlim(xmin - timedelta(hours=1), xmax + timedelta(hours=1))
-    ax_ratio.set_ylim(0, 2)
-    ax_ratio.hlines(1, ratios_df.at[0,'time'], ratios_df.at[1,'time'], colors='#F0D6A2', lw=20)
-    ax_ratio.hlines(1, ratios_df.at[1,'time'], ratios_df.at[2,'time'], colors='#F0D6A2', lw=20)
-    ax_ratio.hlines(1, ratios_df.at[2,'time'], xmax, colors='#F0D6A2', lw=20)
-    ax_ratio.vlines([ratios_df.at[1,'time'], ratios_df.at[2,'time']], 0, 2, colors='#eccc8c')
-    ax_ratio.text(
-        ratios_df.at[0,'time'] + timedelta(seconds=(ratios_df.at[1,'time'] - ratios_df.at[0,'time']).seconds / 2), 1, 
-        str(ratios_df.at[0,'ratio']), color='black', ha='center', va='center', weight='bold', size='large')
-    ax_ratio.text(
-        ratios_df.at[1,'time'] + timedelta(seconds=(ratios_df.at[2,'time'] - ratios_df.at[1,'time']).seconds / 2), 1, 
-        str(ratios_df.at[1,'ratio']), color='black', ha='center', va='center', weight='bold', size='large')
-    ax_ratio.text(
-        ratios_df.at[2,'time'] + timedelta(seconds=(xmax - ratios_df.at[2,'time']).seconds / 2), 1, 
-        str(ratios_df.at[2,'ratio']), color='black', ha='center', va='center', weight='bold', size='large')
-
-
-    h_loc = dates.HourLocator(byhour=range(0,24,3))
-    ax_ratio.xaxis.set_major_locator(h_loc)
-    xfmt = dates.DateFormatter('%l %p')
-    ax_ratio.xaxis.set_major_formatter(xfmt)
-    ax_ratio.tick_params(which='minor', left=False, labelleft=False, 
-                        bottom=False, labelbottom=False, 
-                        top=False, labeltop=False)
-    ax_ratio.tick_params(which='major', left=False, labelleft=False, 
-                        bottom=False, labelbottom=False, 
-                        top=False, labeltop=False)
-    ax_ratio.grid(True, axis='x')
-
-    legend_elements = [Line2D([0], [0], color='#652CDF', marker='o', lw=1, label='Blood Glucose'),
-                    Line2D([0], [0], marker='o', color='white', label='Carb Input (g)',
-                            markerfacecolor='#F0C46E', markersize=15),
-                    Line2D([0], [0], marker='s', color='white', label='Bolus', 
-                            markerfacecolor='#B5ACF2', markersize=13),
-                    Line2D([0], [0], color='#F06688', lw=2, label='Basal'),
-                    Patch(facecolor='#F0D6A2', edgecolor='#eccc8c',
-                            label='Insulin Carb Ratio')]
-
-    ax.legend(handles=legend_elements, loc='center', fontsize='large',
-            ncol=5, bbox_to_anchor=(0., 1.02, 1., .102))
-    plt.savefig(figure_path, bbox_inches='tight', format='pdf')
+
+import ingest
+import profiling
+import stats
+import schema
+import segments
+import timeindex
+
+SHEETS = {'CGM': ['mg/dl'],
+          'Bolus': ['normal', 'carbInput', 'insulinCarbRatio'],
+          'Basal': ['rate']}
+
+# The day drawn: Thursday of week 20
+WEEK = 20
+WEEKDAY = schema.WEEKDAYS.index('Thursday')
+
+def setup_tables(subject_path):
+    print("Setting up tables")
+    dataset_path, file = os.path.split(subject_path)
+    cohort = ingest.CohortBuilder(SHEETS)
+    frames, counts = ingest.load_subject(dataset_path or '.', file, SHEETS)
+    cohort.add(schema.subject_id(file), frames, counts)
+    print(cohort.summary())
+
+    return cohort.build('CGM'), cohort.build('Bolus'), cohort.build('Basal')
+
+
+def find_day(index, subject, week=WEEK, weekday=WEEKDAY, year=None):
+    # Day number of the weekday of the given week in year, or without a year
+    # in the first year of the subject's CGM data with readings on that day;
+    # None if there is none. The original script pooled that weekday of
+    # every year onto one plot; one day is drawn now, so pass year to pick
+    # a later one.
+    span = index.span(subject, 'CGM')
+    if span is None:
+        return None
+    if year is None:
+        years = range(schema.year_of(span[0] // schema.SECONDS_PER_DAY),
+                      schema.year_of(span[1] // schema.SECONDS_PER_DAY) + 1)
+    else:
+        years = [year]
+    for year in years:
+        day = schema.week_day(year, week, weekday)
+        if len(index.day(subject, day)['CGM']):
+            return day
+    return None
+
+
+def pick_day(cgm_df, bolus_df, basal_df, week=WEEK, weekday=WEEKDAY, year=None):
+    # (TimeIndex of one subject's tables, subject, day number find_day picks)
+    index = timeindex.TimeIndex({'CGM': cgm_df, 'Bolus': bolus_df, 'Basal': basal_df})
+    subject = index.subjects()[0]
+    day = find_day(index, subject, week, weekday, year)
+    if day is None:
+        raise ValueError("Subject {} has no CGM readings on {} of week {}{}".format(
+            subject, schema.WEEKDAYS[weekday], week, '' if year is None else ' of ' + str(year)))
+    return index, subject, day
+
+
+def day_streams(index, subject, day):
+    # The subject's CGM, Bolus and Basal records of one day, oldest first,
+    # with plottable times
+    tables = []
+    for name, df in index.day(subject, day).items():
+        df = df.copy()
+        df['time'] = schema.to_datetime(df['epoch'])
+        tables.append(df)
+    return tables
+
+
+def day_seeds(index, subject, day_start):
+    # Basal rate and carb ratio in effect at day_start: those of the last
+    # Basal and Bolus records before it (basal rate 0 and no ratio if none)
+    basal = index.last_before(subject, 'Basal', day_start)
+    bolus = index.last_before(subject, 'Bolus', day_start)
+    basal_seed = 0 if basal is None or pd.isna(basal['rate']) else basal['rate']
+    ratio_seed = None if bolus is None else bolus['insulinCarbRatio']
+    return basal_seed, ratio_seed
+
+
+def day_tables(cgm_df, bolus_df, basal_df, week=WEEK, weekday=WEEKDAY, year=None):
+    # One subject's CGM, Bolus and Basal records of the day find_day picks
+    return day_streams(*pick_day(cgm_df, bolus_df, basal_df, week, weekday, year))
+
+
+def write_stats(cgm_df, bolus_df, basal_df, figure_path, year=None):
+    # The day's CGM, Bolus and Basal records as CSV files next to the figure
+    stem = os.path.splitext(figure_path)[0]
+    for name, df in zip(['cgm', 'bolus', 'basal'], day_tables(cgm_df, bolus_df, basal_df, year=year)):
+        stats.write_table(df, stem + '_' + name + '.csv')
+
+
+# Figure 1's three-panel daily view (glucose, bolus and basal, insulin-to-
+# carb ratio). DailyView builds the figure, axes, legend and artists once and
+# update() draws one subject-day by replacing the artists' data, so
+# make_figure and dailyviews.py, which pages through every day of every
+# subject, share the drawing.
+
+PURPLE = '#652CDF'
+LIGHT_PURPLE = '#B5ACF2'
+SALMON = '#F06688'
+BRIGHT_YELLOW = '#F0C46E'
+LIGHT_YELLOW = '#F0D6A2'
+DARK_YELLOW = '#eccc8c'
+
+BAR_WIDTH = 0.03
+MARGIN = 1 / 24
+
+
+class DailyView:
+
+    def __init__(self, titled=True):
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as dates
+        import matplotlib.ticker as ticker
+        import matplotlib.gridspec as gridspec
+        from matplotlib.collections import LineCollection, PolyCollection
+        from matplotlib.patches import Patch
+        from matplotlib.lines import Line2D
+
+        self.date2num = dates.date2num
+        self.fig = plt.figure(figsize=(15, 10))
+        gs = gridspec.GridSpec(nrows=3, ncols=1, height_ratios=[7, 7, 2])
+        self.fig.subplots_adjust(hspace=0.5, wspace=0.1, top=0.88 if titled else None)
+        self.title = self.fig.suptitle('', fontsize=18) if titled else None
+
+        self.ax = self.fig.add_subplot(gs[0])
+        self.ax_bolus = self.fig.add_subplot(gs[1], sharex=self.ax)
+        self.ax_basal = self.ax_bolus.twinx()
+        self.ax_ratio = self.fig.add_subplot(gs[2], sharex=self.ax)
+
+        self.cgm, = self.ax.plot([], [], marker='o', color=PURPLE, linestyle='none')
+        self.high, = self.ax.plot([], [], 'k', linewidth=2)
+        self.low, = self.ax.plot([], [], 'k', linewidth=2)
+        self.high_label = self.ax.text(0, 180, '180', fontsize=12)
+        self.low_label = self.ax.text(0, 70, '70', fontsize=12)
+        self.ax.set_xlabel("Time of Day", fontsize=18)
+        self.ax.set_ylabel("Blood Glucose (mg/dL)", fontsize=18)
+        self.ax.set_ylim(0, 400)
+        self.ax.yaxis.set_minor_locator(ticker.AutoMinorLocator())
+        self.ax.yaxis.set_major_locator(ticker.MultipleLocator(base=100))
+        self.ax.yaxis.set_major_formatter(ticker.FormatStrFormatter("%d"))
+
+        self.bars = PolyCollection([], facecolors=LIGHT_PURPLE)
+        self.ax_bolus.add_collection(self.bars)
+        self.carb_labels = []
+        self.basal, = self.ax_basal.plot([], [], color=SALMON, linewidth=2)
+        self.ax_bolus.set_xlabel("Time of Day", fontsize=18)
+        self.ax_bolus.set_ylabel("Bolus (units)", fontsize=18)
+        self.ax_basal.set_ylabel("Basal (units)", fontsize=18)
+        self.ax_bolus.yaxis.set_minor_locator(ticker.AutoMinorLocator())
+        self.ax_basal.yaxis.set_minor_locator(ticker.AutoMinorLocator())
+        self.ax_basal.yaxis.set_major_formatter(ticker.FormatStrFormatter("%.2f"))
+        self.ax_basal.tick_params(axis='y', which='major', labelsize=14)
+
+        self.band = LineCollection([], colors=LIGHT_YELLOW, linewidths=20)
+        self.band_edges = LineCollection([], colors=DARK_YELLOW)
+        self.ax_ratio.add_collection(self.band)
+        self.ax_ratio.add_collection(self.band_edges)
+        self.ratio_labels = []
+        self.ax_ratio.set_ylim(0, 2)
+        self.ax_ratio.tick_params(which='both', left=False, labelleft=False,
+                                  bottom=False, labelbottom=False, top=False, labeltop=False)
+        self.ax_ratio.grid(True, axis='x')
+
+        for axis in [self.ax, self.ax_bolus]:
+            axis.xaxis.set_minor_locator(dates.HourLocator())
+            axis.xaxis.set_major_locator(dates.HourLocator(byhour=range(0, 24, 3)))
+            axis.xaxis.set_major_formatter(dates.DateFormatter('%l %p'))
+            axis.tick_params(axis='both', which='major', labelsize=14, labelbottom=True)
+            axis.grid(True)
+
+        legend_elements = [Line2D([0], [0], color=PURPLE, marker='o', lw=1, label='Blood Glucose'),
+                           Line2D([0], [0], marker='o', color='white', label='Carb Input (g)',
+                                  markerfacecolor=BRIGHT_YELLOW, markersize=15),
+                           Line2D([0], [0], marker='s', color='white', label='Bolus',
+                                  markerfacecolor=LIGHT_PURPLE, markersize=13),
+                           Line2D([0], [0], color=SALMON, lw=2, label='Basal'),
+                           Patch(facecolor=LIGHT_YELLOW, edgecolor=DARK_YELLOW, label='Insulin Carb Ratio')]
+        self.ax.legend(handles=legend_elements, loc='center', fontsize='large',
+                       ncol=5, bbox_to_anchor=(0., 1.02, 1., .102))
+
+    def _labels(self, pool, n, make):
+        # The first n artists of pool, creating missing ones and hiding the rest
+        while len(pool) < n:
+            pool.append(make())
+        for i, label in enumerate(pool):
+            label.set_visible(i < n)
+        return pool[:n]
+
+    def _carb_label(self):
+        return self.ax_bolus.annotate('', (0, 0), ha='center', va='center',
+                                      bbox=dict(boxstyle="circle", ec=BRIGHT_YELLOW, fc=BRIGHT_YELLOW, pad=0.5),
+                                      size=12, xytext=(-0.2, -1.5), textcoords='offset points')
+
+    def _ratio_label(self):
+        return self.ax_ratio.text(0, 1, '', color='black', ha='center', va='center',
+                                  weight='bold', size='large')
+
+    def update(self, subject, day, cgm, bolus, basal, basal_seed=0, ratio_seed=None):
+        # Show one subject-day: cgm, bolus and basal are that day's canonical
+        # records, oldest first; the seeds are the basal rate and carb ratio
+        # in effect when the day starts
+        cgm_x = self.date2num(schema.to_datetime(cgm['epoch']))
+        glucose = schema.as_float(cgm['mg/dl'])
+        xmin, xmax = cgm_x.min(), cgm_x.max()
+        if self.title is not None:
+            self.title.set_text('Subject {}, {} {}'.format(
+                subject, schema.WEEKDAYS[(day + 3) % 7], schema.to_datetime([day * schema.SECONDS_PER_DAY])[0].date()))
+
+        self.cgm.set_data(cgm_x, glucose)
+        self.high.set_data([xmin, xmax], [180, 180])
+        self.low.set_data([xmin, xmax], [70, 70])
+        self.high_label.set_x(xmax)
+        self.low_label.set_x(xmax)
+
+        bolus = bolus[bolus['normal'].notna()]
+        bolus_x = self.date2num(schema.to_datetime(bolus['epoch']))
+        doses = bolus['normal'].to_numpy()
+        self.bars.set_verts([[(x - BAR_WIDTH / 2, 0), (x - BAR_WIDTH / 2, h),
+                              (x + BAR_WIDTH / 2, h), (x + BAR_WIDTH / 2, 0)] for x, h in zip(bolus_x, doses)])
+        carbs = bolus['carbInput'].to_numpy()
+        with_carbs = carbs > 0
+        for label, x, h, carb in zip(self._labels(self.carb_labels, with_carbs.sum(), self._carb_label),
+                                     bolus_x[with_carbs], doses[with_carbs], carbs[with_carbs]):
+            label.set_text(format(carb, '.0f'))
+            label.xy = (x, h + 0.2)
+        self.ax_bolus.set_ylim(0, max(1.75, doses.max() + 0.4 if len(doses) else 0))
+
+        basal_x = self.date2num(schema.to_datetime(basal['epoch']))
+        rates = basal['rate'].fillna(0).to_numpy()
+        steps = segments.step_segments(basal_x, rates, xmin, xmax, basal_seed)
+        self.basal.set_data(*segments.step_points(steps))
+        self.ax_basal.set_ylim(0, max(1, steps['value'].max() * 1.1 if len(steps) else 0))
+
+        ratios = segments.step_segments(bolus_x, bolus['insulinCarbRatio'], xmin, xmax, ratio_seed)
+        starts, ends = ratios['start'].to_numpy(), ratios['end'].to_numpy()
+        self.band.set_segments(np.stack([np.c_[starts, np.ones(len(starts))],
+                                         np.c_[ends, np.ones(len(ends))]], axis=1))
+        # No segments at all before the subject's first bolus
+        edges = max(len(starts) - 1, 0)
+        self.band_edges.set_segments(np.stack([np.c_[starts[1:], np.zeros(edges)],
+                                               np.c_[starts[1:], np.full(edges, 2)]], axis=1))
+        labels = self._labels(self.ratio_labels, len(ratios), self._ratio_label)
+        for label, start, end, ratio in zip(labels, starts, ends, ratios['value']):
+            label.set_text('{:g}'.format(ratio))
+            label.set_position(((start + end) / 2, 1))
+
+        self.ax.set_xlim(xmin - MARGIN, xmax + MARGIN)
+
+    def save(self, target):
+        # target is a file path or an open PdfPages
+        if isinstance(target, str):
+            self.fig.savefig(target, format=os.path.splitext(target)[1][1:] or 'pdf')
+        else:
+            target.savefig(self.fig)
+
+
+def make_figure(cgm_df, bolus_df, basal_df, figure_path, year=None):
+    with profiling.stage('figure1 pick day') as record:
+        index, subject, day = pick_day(cgm_df, bolus_df, basal_df, year=year)
+        streams = index.day(subject, day)
+        basal_seed, ratio_seed = day_seeds(index, subject, day * schema.SECONDS_PER_DAY)
+        record['rows'] = sum(len(stream) for stream in streams.values())
+
+    view = DailyView(titled=False)
+    view.update(subject, day, streams['CGM'], streams['Bolus'], streams['Basal'], basal_seed, ratio_seed)
+    with profiling.stage('savefig'):
+        view.fig.savefig(figure_path, bbox_inches='tight', format='pdf')
     # plt.show()
 
 
 def main(argv):
     subject_path = ''
     figure_path = ''
+    year = None
+    stats_only = False
+    profile_path = None
 
     try:
-        opts, args = getopt.getopt(argv,"hs:f:",["subjectPath=","figurePath="])
+        opts, args = getopt.getopt(argv,"hs:f:y:",["subjectPath=","figurePath=","year=","stats-only","profile="])
     except getopt.GetoptError:
-        print('figure1.py -s <path to subject data file> -f <path to image pdf>') 
+        print('figure1.py -s <path to subject data file> -f <path to image pdf> [-y <year>] [--stats-only] [--profile <trace file>]') 
         sys.exit(2)
     
     for opt, arg in opts:
         if opt == '-h':
-            print('figure1.py -s <path to subject data file> -f <path to image pdf>') 
+            print('figure1.py -s <path to subject data file> -f <path to image pdf> [-y <year>] [--stats-only] [--profile <trace file>]') 
             print('figure1.py -s ../dataset/Subject31.xlsx -f ../Figures/sub31_week20_thursday.pdf') 
             sys.exit()
         elif opt in ("-s", "--subjectPath"):
             subject_path = arg
         elif opt in ("-f", "--figurePath"):
             figure_path = arg
+        elif opt in ("-y", "--year"):
+            year = int(arg)
+        elif opt == "--stats-only":
+            stats_only = True
+        elif opt == "--profile":
+            profile_path = arg
         else:
-            print('figure1.py -s <path to subject data file> -f <path to image pdf>') 
-    if (len(argv) != 4):
-        print('figure1.py -s <path to subject data file> -f <path to image pdf>') 
+            print('figure1.py -s <path to subject data file> -f <path to image pdf> [-y <year>] [--stats-only] [--profile <trace file>]') 
+    if (len(argv) < 4):
+        print('figure1.py -s <path to subject data file> -f <path to image pdf> [-y <year>] [--stats-only] [--profile <trace file>]') 
         sys.exit()
 
     print('Path to subject file is ' + subject_path) 
     print('Path to image file is ' + figure_path)
-    make_figure(subject_path, figure_path)
+    if profile_path:
+        profiling.start(profile_path, ['figure1.py'] + argv)
+    cgm_df, bolus_df, basal_df = profiling.run('figure1 setup tables', setup_tables, subject_path)
+    if stats_only:
+        profiling.run('figure1 write stats', write_stats, cgm_df, bolus_df, basal_df, figure_path, year)
+    else:
+        profiling.run('figure1 make figure', make_figure, cgm_df, bolus_df, basal_df, figure_path, year)
+    profiling.finish()
 
 
 if __name__ == "__main__":
@@ -8,105 +8,42 @@ import math
 import json
 from time import time
 from datetime import datetime, timedelta, time,date
-import seaborn as sns
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.dates as pltdates
-import matplotlib.dates as dates
-import matplotlib.ticker as ticker
-from matplotlib.ticker import FuncFormatter
-import matplotlib.gridspec as gridspec
-from matplotlib.patches import Patch, Rectangle
-from matplotlib.lines import Line2D
-
-def setup_tables(dataset_path):
+
+import ingest
+import profiling
+import stats
+import metrics
+
+def setup_tables(dataset_path, workers=1):
     print("Setting up tables")
-    cleaned_files = os.listdir(dataset_path)
+    cohort = ingest.load_cohort(dataset_path, {'CGM': ['mg/dl'], 'Bolus': ['normal', 'carbInput']}, workers)
+    print(cohort.summary())
 
     # Read in CGM data
-    cbg_df = pd.DataFrame()
-    subject = []
-    for file in cleaned_files:
-        try:
-            df = pd.read_excel(dataset_path + "/" + file, sheet_name='CGM')
-            df['time'] = pd.to_datetime(df['date'], utc=True, infer_datetime_format=True)
-            unique_df = df.drop_duplicates(subset=['time'])
-            new_df = unique_df.dropna(subset=['time'])
-            new_df['subject'] = file.replace('.xlsx', '')
-            cbg_df = cbg_df.append(new_df)
-        except:
-            pass
+    cbg_df = cohort.build('CGM')
 
     # Read in Bolus data
-    bolus_df = pd.DataFrame()
-    for file in cleaned_files:
-        sub = file.replace('.xlsx', '')
-        try:
-            df = pd.read_excel(dataset_path + "/" + file, sheet_name='Bolus')
-            df['time'] = pd.to_datetime(df['date'], utc=True, infer_datetime_format=True)
-            unique_df = df.drop_duplicates(subset=['time'])
-            new_df = unique_df.dropna(subset=['time'])
-            new_df['Subject'] = [sub] * len(new_df)
-            bolus_df = bolus_df.append(new_df)
-        except:
-            pass
-    
-    # Format CGM data
-    cbg_df['date'] = pd.to_datetime(cbg_df['date'], utc=True, infer_datetime_format=True)
-    cbg_df = cbg_df[['subject', 'date', 'time', 'mg/dl']]
-    cbg_df['dt_date'] = pd.to_datetime(cbg_df['date']).dt.date
-
-    days_with_cgm_data = {}
-
-    for subject in cbg_df['subject'].unique():
-        sub_df = cbg_df[cbg_df['subject'] == subject].copy()
-        for dt_date in sub_df['dt_date'].unique():
-            unique_date_df = sub_df[sub_df['dt_date'] == dt_date].copy()
-            if len(unique_date_df) > 10:
-                if subject in days_with_cgm_data:
-                    days_with_cgm_data[subject] += 1 
-                else:
-                    days_with_cgm_data[subject] = 1 
-    
-    cgm_days = pd.DataFrame.from_dict(days_with_cgm_data, orient='index', columns=['DaysCollected'])
-    cgm_days.sort_values(by='DaysCollected', ascending=False, inplace=True)
-    cgm_days = cgm_days.reset_index().rename(columns={"index": "CohortID"})
-    cgm_days.index = range(1, len(days_with_cgm_data) + 1)
-    cgm_days = cgm_days.rename_axis("Key")
-    # cgm_days.to_csv('tables/cgm_days_collected.csv')
-
-    # Format Bolus data
-    bolus_df = bolus_df[['Subject', 'time', 'normal', 'carbInput']]
-    bolus_df['dt_date'] = pd.to_datetime(bolus_df['time']).dt.date
-
-    days_with_bolus_data = {}
-    for subject in bolus_df['Subject'].unique():
-        sub_df = bolus_df[bolus_df['Subject'] == subject].copy()
-        for dt_date in sub_df['dt_date'].unique():
-            unique_date_df = sub_df[sub_df['dt_date'] == dt_date].copy()
-            if subject in days_with_bolus_data:
-                days_with_bolus_data[subject] += 1 
-            else:
-                days_with_bolus_data[subject] = 1 
-
-    bolus_days = pd.DataFrame.from_dict(days_with_bolus_data, orient='index', columns=['DaysCollected'])
-    bolus_days.sort_values(by='DaysCollected', ascending=False, inplace=True)
-    bolus_days = bolus_days.reset_index().rename(columns={"index": "CohortID"})
-    bolus_days.index = range(1, len(days_with_bolus_data) + 1)
-    # bolus_days = bolus_days.rename_axis("Key")
-
-    cgm_days.rename(columns={'DaysCollected':'CGM_DaysCollected'}, inplace=True)
-    bolus_days.rename(columns={'DaysCollected':'Bolus_DaysCollected'}, inplace=True)
-
-    # bolus_days.drop(columns=['Key'], inplace=True)
-
-    cgm_days = cgm_days[cgm_days['CGM_DaysCollected'] >= 30]
-    bolus_days = bolus_days[bolus_days['CohortID'].isin(cgm_days['CohortID'].unique())]
-
-    bolus_days = bolus_days[bolus_days['Bolus_DaysCollected'] >= 30]
-    cgm_days = cgm_days[cgm_days['CohortID'].isin(bolus_days['CohortID'].unique())]
-
-    days_collected = cgm_days.merge(bolus_days, how='outer', on='CohortID')
+    bolus_df = cohort.build('Bolus')
+
+    return profiling.run('figure2 days collected', days_collected_table, cbg_df, bolus_df)
+
+
+def days_collected_table(cbg_df, bolus_df):
+    return days_collected_from(metrics.cohort_summary(cbg_df, bolus_df))
+
+
+def days_collected_from(summary):
+    # Subjects with at least 30 days of both CGM and insulin pump data,
+    # ordered by days of CGM data and then subject number, and labelled
+    # SubjectNN as the workbooks are
+    cgm_days = summary.loc[summary['cgm_days'] > 0, ['cgm_days']].sort_values(
+        ['cgm_days', 'subject'], ascending=[False, True], kind='stable')['cgm_days']
+    bolus_days = summary.loc[cgm_days.index, 'pump_days']
+    eligible = (cgm_days >= 30) & (bolus_days >= 30)
+
+    days_collected = pd.DataFrame({'CohortID': ['Subject{}'.format(subject) for subject in cgm_days.index[eligible.values]],
+                                   'CGM_DaysCollected': cgm_days[eligible].astype(int).values,
+                                   'Bolus_DaysCollected': bolus_days[eligible].astype(int).values})
     days_collected['Key'] = range(1, len(days_collected) + 1)
     # days_collected.to_csv('tables/days_collected.csv', index=False)
 
@@ -114,8 +51,16 @@ def setup_tables(dataset_path):
   
 
 
+def write_stats(days_collected, figure_path):
+    # CGM and Bolus day counts per subject, next to the figure as CSV
+    stats.write_table(days_collected, os.path.splitext(figure_path)[0] + '.csv')
+
+
 def make_figure(days_collected, figure_path):
-    
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
     fig, axs = plt.subplots(nrows=2, ncols=1, figsize=(15, 10))
     fig.subplots_adjust(hspace=0.4)
     sns.set_theme(style="whitegrid")
@@ -186,42 +131,58 @@ def make_figure(days_collected, figure_path):
                 horizontalalignment='left', verticalalignment='bottom',
                 )
 
-    fig.savefig(figure_path, format='pdf', dpi=300)
+    with profiling.stage('savefig'):
+        fig.savefig(figure_path, format='pdf', dpi=300)
 
 
 
 def main(argv):
     datadir_path = ''
     figure_path = ''
+    workers = 1
+    stats_only = False
+    profile_path = None
 
-    if (len(argv) != 4):
+    if (len(argv) < 4):
         print("Incorrent number of arguments: " + str(len(argv)))
-        print('figure2.py -d <path to dataset directory> -f <path to image pdf>') 
+        print('figure2.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
         sys.exit(2)
     
     try:
-        opts, args = getopt.getopt(argv,"hd:f:",["datasetDir=","figurePath="])
+        opts, args = getopt.getopt(argv,"hd:f:w:",["datasetDir=","figurePath=","workers=","stats-only","profile="])
     except getopt.GetoptError:
-        print('GetoptError:\t figure2.py -d <path to dataset directory> -f <path to image pdf>') 
+        print('GetoptError:\t figure2.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
         sys.exit(2)
     
     for opt, arg in opts:
         if opt == '-h':
-            print('figure2.py -d <path to dataset directory> -f <path to image pdf>') 
+            print('figure2.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
             print('Example:\t figure2.py -d ../dataset/ -f ../Figures/totaldays.pdf') 
             sys.exit()
         elif opt in ("-d", "--datasetDir"):
             datadir_path = arg
         elif opt in ("-f", "--figurePath"):
             figure_path = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt == "--stats-only":
+            stats_only = True
+        elif opt == "--profile":
+            profile_path = arg
         else:
-            print('figure2.py -d <path to dataset directory> -f <path to image pdf>') 
+            print('figure2.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
 
     print('Path to dataset directory is ' + datadir_path) 
     print('Path to image file is ' + figure_path)
 
-    days_collected = setup_tables(datadir_path)
-    make_figure(days_collected, figure_path)
+    if profile_path:
+        profiling.start(profile_path, ['figure2.py'] + argv)
+    days_collected = profiling.run('figure2 setup tables', setup_tables, datadir_path, workers)
+    if stats_only:
+        profiling.run('figure2 write stats', write_stats, days_collected, figure_path)
+    else:
+        profiling.run('figure2 make figure', make_figure, days_collected, figure_path)
+    profiling.finish()
 
 
 if __name__ == "__main__":
@@ -6,91 +6,62 @@ import os, getopt
 import sys
 from time import time
 from datetime import datetime, timedelta, time,date
-import seaborn as sns
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.dates as pltdates
-import matplotlib.dates as dates
-import matplotlib.ticker as ticker
-from matplotlib.ticker import FuncFormatter
-import matplotlib.gridspec as gridspec
-from matplotlib.patches import Patch, Rectangle
-from matplotlib.lines import Line2D
-
-def setup_tables(dataset_path):
+
+import ingest
+import stats
+import metrics
+import profiling
+
+def setup_tables(dataset_path, workers=1):
     print("Setting up tables")
-    cleaned_files = os.listdir(dataset_path)
+    cohort = ingest.load_cohort(dataset_path, {'CGM': ['mg/dl'], 'Bolus': ['normal', 'carbInput']}, workers)
+    print(cohort.summary())
 
     # Read in CGM data
-    cbg_df = pd.DataFrame()
-    for file in cleaned_files:
-        try:
-            df = pd.read_excel(dataset_path + "/" + file, sheet_name='CGM')
-            df['time'] = pd.to_datetime(df['date'], utc=True, infer_datetime_format=True)
-            unique_df = df.drop_duplicates(subset=['time'])
-            new_df = unique_df.dropna(subset=['time'])
-            new_df['subject'] = file.replace('.xlsx', '')
-            cbg_df = cbg_df.append(new_df)
-        except:
-            pass
+    cbg_df = cohort.build('CGM')
 
     # Read in Bolus data
-    bolus_df = pd.DataFrame()
-    for file in cleaned_files:
-        sub = file.replace('.xlsx', '')
-        try:
-            df = pd.read_excel(dataset_path + "/" + file, sheet_name='Bolus')
-            df['time'] = pd.to_datetime(df['date'], utc=True, infer_datetime_format=True)
-            unique_df = df.drop_duplicates(subset=['time'])
-            new_df = unique_df.dropna(subset=['time'])
-            new_df['Subject'] = [sub] * len(new_df)
-            bolus_df = bolus_df.append(new_df)
-        except:
-            pass
-    
-    # Format CGM data
-    cbg_df['date'] = pd.to_datetime(cbg_df['time'], utc=True, infer_datetime_format=True)
-    cbg_df['day'] = cbg_df['date'].dt.strftime('%A')
-    cbg_df['week'] = cbg_df['date'].dt.strftime('%W')
-    cbg_df['time'] = cbg_df['date'].dt.time
-    cbg_df['subject'] = cbg_df['subject'].str[7:].astype(int)
-    cbg_df = cbg_df[['subject', 'date', 'day', 'week', 'time', 'mg/dl']]
-
-    # Format Bolus data
-    bolus_df = bolus_df[['Subject', 'time', 'normal', 'carbInput']]
-    bolus_df['dt_date'] = pd.to_datetime(bolus_df['time']).dt.date
+    bolus_df = cohort.build('Bolus')
 
     return cbg_df, bolus_df
   
 
 
+def pump_counts(pump_df):
+    return pump_counts_from(metrics.cohort_summary(bolus_df=pump_df))
+
+
+def pump_counts_from(summary):
+    # Bolus doses and carb inputs of every subject with a bolus, by subject
+    counts = summary.loc[summary['bolus_count'] > 0, ['bolus_count', 'carb_count']]
+    return counts.astype(int).sort_index()
+
+
+def write_stats(counts, figure_path):
+    # Bolus dose and carb input counts per subject, next to the figure as CSV
+    stats.write_table(counts, os.path.splitext(figure_path)[0] + '.csv', index=True)
+
+
 def make_figure(cgm_df, pump_df, figure_path):
+    counts = profiling.run('figure3 pump counts', pump_counts, pump_df)
+    profiling.run('figure3 plot figure', plot_figure, counts, figure_path)
+
+
+def plot_figure(counts, figure_path):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
     PURPLE = "#652CDF"
     LIGHTER_PURPLE = "#A291DB"
     LIGHT_PURPLE = "#B5ACF2"
     BRIGHT_YELLOW = "#F0C46E"
     LIGHT_YELLOW = "#F0D6A2"
 
-    subjects_sorted = sorted(cgm_df['subject'].unique().tolist())
-    pump_df['Subject'] = pump_df['Subject'].str[7:].astype(int)
-    pump_df['dt_date'] = pd.to_datetime(pump_df['time']).dt.date
-    pump_df.sort_values(by=["Subject", "dt_date"], ascending=True, inplace=True)
-    carbs_df = pump_df[pump_df['carbInput'] > 0].copy()
-    bolus_df = pump_df[pump_df['normal'] > 0].copy()
-
-    pump_subjects = []
-    bolus_doses = []
-
-    for s in bolus_df['Subject'].unique():
-        subject_df = bolus_df[bolus_df['Subject'] == s].copy()
-        pump_subjects.append(s)
-        bolus_doses.append(len(subject_df))
-        
-    carb_inputs = []
-    for s in pump_subjects:
-        subject_df = carbs_df[carbs_df['Subject'] == s].copy()
-        carb_inputs.append(len(subject_df))    
-    
+    pump_subjects = counts.index.tolist()
+    bolus_doses = counts['bolus_count'].tolist()
+    carb_inputs = counts['carb_count'].tolist()
+
     fig, axs = plt.subplots(nrows=2, ncols=1, figsize=(15, 10))
     fig.subplots_adjust(hspace=0.4)
     sns.set_theme(style="whitegrid")
@@ -170,42 +141,59 @@ def make_figure(cgm_df, pump_df, figure_path):
                 )
 
 
-    fig.savefig(figure_path, format='pdf', dpi=300)
+    with profiling.stage('savefig'):
+        fig.savefig(figure_path, format='pdf', dpi=300)
 
 
 
 def main(argv):
     datadir_path = ''
     figure_path = ''
+    workers = 1
+    stats_only = False
+    profile_path = None
 
-    if (len(argv) != 4):
+    if (len(argv) < 4):
         print("Incorrent number of arguments: " + str(len(argv)))
-        print('figure3.py -d <path to dataset directory> -f <path to image pdf>') 
+        print('figure3.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
         sys.exit(2)
     
     try:
-        opts, args = getopt.getopt(argv,"hd:f:",["datasetDir=","figurePath="])
+        opts, args = getopt.getopt(argv,"hd:f:w:",["datasetDir=","figurePath=","workers=","stats-only","profile="])
     except getopt.GetoptError:
-        print('GetoptError:\t figure3.py -d <path to dataset directory> -f <path to image pdf>') 
+        print('GetoptError:\t figure3.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
         sys.exit(2)
     
     for opt, arg in opts:
         if opt == '-h':
-            print('figure3.py -d <path to dataset directory> -f <path to image pdf>') 
+            print('figure3.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
             print('Example:\t figure3.py -d ../dataset/ -f ../Figures/totaldays.pdf') 
             sys.exit()
         elif opt in ("-d", "--datasetDir"):
             datadir_path = arg
         elif opt in ("-f", "--figurePath"):
             figure_path = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt == "--stats-only":
+            stats_only = True
+        elif opt == "--profile":
+            profile_path = arg
         else:
-            print('figure3.py -d <path to dataset directory> -f <path to image pdf>') 
+            print('figure3.py -d <path to dataset directory> -f <path to image pdf> [-w <number of workers>] [--stats-only] [--profile <trace file>]') 
 
     print('Path to dataset directory is ' + datadir_path) 
     print('Path to image file is ' + figure_path)
 
-    cgm_df, bolus_df = setup_tables(datadir_path)
-    make_figure(cgm_df, bolus_df, figure_path)
+    if profile_path:
+        profiling.start(profile_path, ['figure3.py'] + argv)
+    cgm_df, bolus_df = profiling.run('figure3 setup tables', setup_tables, datadir_path, workers)
+    if stats_only:
+        counts = profiling.run('figure3 pump counts', pump_counts, bolus_df)
+        profiling.run('figure3 write stats', write_stats, counts, figure_path)
+    else:
+        make_figure(cgm_df, bolus_df, figure_path)
+    profiling.finish()
 
 
 if __name__ == "__main__":
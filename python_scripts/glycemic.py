@@ -0,0 +1,353 @@
+#!/usr/bin/python
+
+import sys, getopt
+import math
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+import grid
+import ingest
+import metrics
+import profiling
+import schema
+import stats
+
+# Extended glycemic indices of every subject-day and subject, computed for
+# the whole cohort at once from its 5-minute CGM grid (see grid.py):
+#
+#   mean, std   mg/dL, sample standard deviation
+#   gmi         glucose management indicator, 3.31 + 0.02392 * mean (%)
+#   j_index     0.001 * (mean + std)^2
+#   lbgi, hbgi  low and high blood glucose indices: the mean of
+#               10 * f(g)^2 over the readings where f(g) < 0 (lbgi) or
+#               f(g) > 0 (hbgi), f(g) = 1.509 * (ln(g)^1.084 - 5.381)
+#   conga       standard deviation of the differences between every reading
+#               and the one CONGA_HOURS earlier
+#   mage        mean amplitude of the glycemic excursions: the rises and
+#               falls between turning points that exceed the day's std,
+#               found with a threshold of one std (both directions
+#               averaged)
+#
+# Day rows cover the subject-days with more than metrics.MIN_DAILY_READINGS
+# readings; a day's conga pairs end on that day and may start on the day
+# before. Subject rows (no day) take every reading of the subject, except
+# mage, which averages the excursions of the subject's day rows. The
+# indices are reductions over the grid's slot axis; only the excursion
+# search steps through the slots of a day, for every subject-day of a block
+# at once. Subjects are independent, so the grid (possibly memory-mapped)
+# is processed in blocks of whole subjects of at most BLOCK_SLOTS slots
+# and only a block is ever held as float64.
+# reference_metrics computes the day rows one subject-day at a time in
+# plain Python, for checking and benchmarking.
+
+CONGA_HOURS = 1
+BLOCK_SLOTS = 1 << 22
+COLUMNS = ['subject', 'day', 'readings', 'mean', 'std', 'gmi', 'j_index', 'lbgi', 'hbgi', 'conga', 'mage']
+
+
+def _moments(values, axis):
+    # Counts, means and sample standard deviations of the non-NaN values
+    # along axis
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, values, 0).sum(axis=axis) / count
+        squares = np.where(valid, values - np.expand_dims(mean, axis), 0) ** 2
+        std = np.sqrt(squares.sum(axis=axis) / (count - 1))
+    return count, mean, std
+
+
+def risks(values):
+    # (low, high) risk of every reading, 0 for gaps
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f = 1.509 * (np.log(values) ** 1.084 - 5.381)
+    risk = 10 * f ** 2
+    return np.where(f < 0, risk, 0), np.where(f > 0, risk, 0)
+
+
+def lagged_differences(timeline, lag):
+    # Differences between every slot of subjects x slots timelines and the
+    # slot lag earlier, NaN where either is a gap
+    differences = np.full(timeline.shape, np.nan)
+    differences[:, lag:] = timeline[:, lag:] - timeline[:, :-lag]
+    return differences
+
+
+def excursions(values, thresholds):
+    # Sum and count of the excursions larger than each row's threshold in
+    # rows x slots values (NaN for gaps). Every row steps from turning
+    # point to turning point: a rise ends at a peak once the values fall
+    # more than the threshold below it, a fall at a nadir likewise, and the
+    # first excursion starts at the lowest or highest value before it.
+    rows = values.shape[0]
+    direction = np.zeros(rows, dtype='int8')
+    low = np.full(rows, np.inf)
+    high = np.full(rows, -np.inf)
+    turn = np.full(rows, np.nan)
+    extreme = np.full(rows, np.nan)
+    total = np.zeros(rows)
+    count = np.zeros(rows, dtype='int64')
+    slots = np.ascontiguousarray(values.T)
+    with np.errstate(invalid='ignore'):
+        for x in slots:
+            # Comparisons with a gap are False, so gaps change nothing
+            undecided = direction == 0
+            low = np.where(undecided, np.fmin(low, x), low)
+            high = np.where(undecided, np.fmax(high, x), high)
+            up = undecided & (x == high) & (x - low > thresholds)
+            down = undecided & (x == low) & (high - x > thresholds)
+
+            peak = (direction == 1) & (extreme - x > thresholds)
+            nadir = (direction == -1) & (x - extreme > thresholds)
+            ended = peak | nadir
+            total += np.where(ended, np.abs(extreme - turn), 0)
+            count += ended
+            turn = np.where(up, low, np.where(down, high, np.where(ended, extreme, turn)))
+            further = ((direction == 1) & (x > extreme)) | ((direction == -1) & (x < extreme))
+            extreme = np.where(up | down | ended | further, x, extreme)
+            direction = np.where(up | nadir, 1, np.where(down | peak, -1, direction)).astype('int8')
+
+    # The last excursion runs to the end of the row
+    ended = direction != 0
+    total[ended] += np.abs(extreme[ended] - turn[ended])
+    count[ended] += 1
+    return total, count
+
+
+def _indices(count, mean, std, low, high, conga):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'readings': count, 'mean': mean, 'std': std,
+                'gmi': 3.31 + 0.02392 * mean,
+                'j_index': 0.001 * (mean + std) ** 2,
+                'lbgi': low, 'hbgi': high, 'conga': conga}
+
+
+def glycemic_metrics(cgm_grid, min_readings=metrics.MIN_DAILY_READINGS, conga_hours=CONGA_HOURS,
+                     block_slots=BLOCK_SLOTS):
+    # Tidy table of COLUMNS: the subject-day rows of every subject, by day,
+    # followed by its subject row (day <NA>); subjects sorted
+    subjects, days, slots = cgm_grid.glucose.shape
+    block = max(1, block_slots // max(1, days * slots))
+    tables = []
+    for start in range(0, subjects, block):
+        part = slice(start, start + block)
+        with profiling.stage('glycemic block') as record:
+            tables.append(_block_metrics(grid.CGMGrid(cgm_grid.subjects[part], cgm_grid.first_day[part],
+                                                      cgm_grid.glucose[part]),
+                                         min_readings, conga_hours))
+            record['rows'] = len(tables[-1])
+    if not tables:
+        return pd.DataFrame(columns=COLUMNS)
+    table = pd.concat(tables, ignore_index=True)
+    table = table.sort_values(['subject', 'day'], na_position='last', kind='stable').reset_index(drop=True)
+    return table[COLUMNS]
+
+
+def _block_metrics(cgm_grid, min_readings, conga_hours):
+    # glycemic_metrics rows of the subjects of cgm_grid, unsorted
+    values = cgm_grid.values()
+    subjects, days, slots = values.shape
+    timeline = values.reshape(subjects, days * slots)
+    low, high = risks(values)
+    differences = lagged_differences(timeline, conga_hours * 3600 // grid.SLOT_SECONDS)
+
+    # Subject-days
+    count, mean, std = _moments(values, 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        day_low = low.sum(axis=2) / count
+        day_high = high.sum(axis=2) / count
+    day_conga = _moments(differences.reshape(values.shape), 2)[2]
+    excursion_total, excursion_count = excursions(values.reshape(subjects * days, slots), std.ravel())
+    excursion_total = excursion_total.reshape(subjects, days)
+    excursion_count = excursion_count.reshape(subjects, days)
+    kept = count > min_readings
+    with np.errstate(invalid='ignore', divide='ignore'):
+        day_mage = excursion_total / excursion_count
+    day_rows = pd.DataFrame({column: day_values[kept] for column, day_values in
+                             _indices(count, mean, std, day_low, day_high, day_conga).items()})
+    day_rows.insert(0, 'subject', np.broadcast_to(cgm_grid.subjects[:, None], kept.shape)[kept])
+    day_rows.insert(1, 'day', pd.array(cgm_grid.days()[kept], dtype='Int32'))
+    day_rows['mage'] = day_mage[kept]
+
+    # Subjects
+    count, mean, std = _moments(timeline, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        subject_low = low.reshape(timeline.shape).sum(axis=1) / count
+        subject_high = high.reshape(timeline.shape).sum(axis=1) / count
+        subject_mage = np.where(kept, excursion_total, 0).sum(axis=1) / np.where(kept, excursion_count, 0).sum(axis=1)
+    subject_rows = pd.DataFrame(_indices(count, mean, std, subject_low, subject_high,
+                                         _moments(differences, 1)[2]))
+    subject_rows.insert(0, 'subject', cgm_grid.subjects)
+    subject_rows.insert(1, 'day', pd.array([pd.NA] * subjects, dtype='Int32'))
+    subject_rows['mage'] = subject_mage
+
+    return pd.concat([day_rows, subject_rows], ignore_index=True)
+
+
+def reference_metrics(cgm_df, min_readings=metrics.MIN_DAILY_READINGS, conga_hours=CONGA_HOURS):
+    # The day rows of glycemic_metrics one subject-day at a time, in plain
+    # Python loops
+    lag = conga_hours * 3600 // grid.SLOT_SECONDS
+    rows = []
+    table = pd.DataFrame({'subject': cgm_df['subject'].to_numpy(), 'epoch': cgm_df['epoch'].to_numpy(),
+                          'mg/dl': schema.as_float(cgm_df['mg/dl'])}).dropna()
+    for subject, subject_df in table.sort_values('epoch', kind='stable').groupby('subject', sort=True):
+        readings = {}
+        for epoch, value in zip(subject_df['epoch'], subject_df['mg/dl']):
+            readings.setdefault(epoch // grid.SLOT_SECONDS, value)
+        by_day = {}
+        for slot in sorted(readings):
+            by_day.setdefault(slot // grid.SLOTS_PER_DAY, []).append(slot)
+
+        for day, day_slots in by_day.items():
+            values = [readings[slot] for slot in day_slots]
+            n = len(values)
+            if n <= min_readings:
+                continue
+            mean = sum(values) / n
+            std = math.sqrt(sum((value - mean) ** 2 for value in values) / (n - 1))
+            low = high = 0.0
+            for value in values:
+                f = 1.509 * (math.log(value) ** 1.084 - 5.381)
+                if f < 0:
+                    low += 10 * f ** 2
+                elif f > 0:
+                    high += 10 * f ** 2
+            differences = [readings[slot] - readings[slot - lag] for slot in day_slots if slot - lag in readings]
+            if len(differences) > 1:
+                difference_mean = sum(differences) / len(differences)
+                conga = math.sqrt(sum((d - difference_mean) ** 2 for d in differences) / (len(differences) - 1))
+            else:
+                conga = float('nan')
+            amplitudes = reference_excursions(values, std)
+            rows.append({'subject': subject, 'day': day, 'readings': n, 'mean': mean, 'std': std,
+                         'gmi': 3.31 + 0.02392 * mean, 'j_index': 0.001 * (mean + std) ** 2,
+                         'lbgi': low / n, 'hbgi': high / n, 'conga': conga,
+                         'mage': sum(amplitudes) / len(amplitudes) if amplitudes else float('nan')})
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def reference_excursions(values, threshold):
+    # Amplitudes of the excursions of one day's readings, as in excursions
+    amplitudes = []
+    direction = 0
+    low = high = turn = extreme = None
+    for x in values:
+        if direction == 0:
+            low = x if low is None else min(low, x)
+            high = x if high is None else max(high, x)
+            if x == high and x - low > threshold:
+                direction, turn, extreme = 1, low, x
+            elif x == low and high - x > threshold:
+                direction, turn, extreme = -1, high, x
+        elif direction == 1:
+            if x > extreme:
+                extreme = x
+            elif extreme - x > threshold:
+                amplitudes.append(extreme - turn)
+                direction, turn, extreme = -1, extreme, x
+        else:
+            if x < extreme:
+                extreme = x
+            elif x - extreme > threshold:
+                amplitudes.append(turn - extreme)
+                direction, turn, extreme = 1, extreme, x
+    if direction != 0:
+        amplitudes.append(abs(extreme - turn))
+    return amplitudes
+
+
+def benchmark(cgm_df):
+    # Times glycemic_metrics (grid included) against reference_metrics on
+    # the same readings and returns the largest difference of every column
+    start = perf_counter()
+    table = glycemic_metrics(grid.build(cgm_df))
+    engine_seconds = perf_counter() - start
+    start = perf_counter()
+    reference = reference_metrics(cgm_df)
+    reference_seconds = perf_counter() - start
+
+    days = table[table['day'].notna()].reset_index(drop=True)
+    print("{} subject-days: engine {:.3f} s, per-day reference {:.3f} s ({:.0f}x)".format(
+        len(reference), engine_seconds, reference_seconds, reference_seconds / engine_seconds))
+    if len(days) != len(reference) or (days['day'].astype('int64').to_numpy() != reference['day'].to_numpy()).any():
+        raise ValueError("The engine and the reference disagree on the subject-days")
+    differences = {}
+    for column in COLUMNS[2:]:
+        a = days[column].to_numpy(dtype=float)
+        b = reference[column].to_numpy(dtype=float)
+        if (np.isnan(a) != np.isnan(b)).any():
+            raise ValueError("The engine and the reference disagree on which days have a {}".format(column))
+        differences[column] = float(np.nanmax(np.abs(a - b))) if len(a) else 0.0
+    print("Largest differences: " + ", ".join("{} {:.2g}".format(column, difference)
+                                               for column, difference in differences.items()))
+    return differences
+
+
+def main(argv):
+    datadir_path = ''
+    output = ''
+    grid_dir = None
+    workers = 1
+    run_benchmark = False
+    profile_path = None
+
+    usage = 'glycemic.py (-d <path to dataset directory> | -g <grid directory>) -o <output csv> [-w <number of workers>] [--benchmark] [--profile <trace file>]'
+    if (len(argv) < 4):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:o:g:w:",["datasetDir=","output=","gridDir=","workers=","benchmark","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t glycemic.py -d ../dataset/ -o ../Figures/glycemic_metrics.csv --benchmark')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-g", "--gridDir"):
+            grid_dir = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt == "--benchmark":
+            run_benchmark = True
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    # A stored grid needs no dataset, except to benchmark against its readings
+    if not datadir_path and (run_benchmark or not grid_dir):
+        print("A dataset directory (-d) is needed " + ("to benchmark" if grid_dir else "without a grid (-g)"))
+        print(usage)
+        sys.exit(2)
+
+    if profile_path:
+        profiling.start(profile_path, ['glycemic.py'] + argv)
+    cgm_df = None
+    if grid_dir and not run_benchmark:
+        cgm_grid = profiling.run('read grid', grid.read_grid, grid_dir)
+    else:
+        cohort = profiling.run('load cohort', ingest.load_cohort, datadir_path, {'CGM': ['mg/dl']}, workers)
+        print(cohort.summary())
+        cgm_df = cohort.build('CGM')
+        cgm_grid = profiling.run('build grid', grid.build, cgm_df)
+    print(grid.summary(cgm_grid))
+    table = profiling.run('glycemic metrics', glycemic_metrics, cgm_grid)
+    profiling.run('write table', stats.write_table, table, output)
+    if run_benchmark:
+        profiling.run('benchmark', benchmark, cgm_df)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import arrays
+import ingest
+import metrics
+import profiling
+import schema
+
+# Every subject's CGM readings snapped onto a dense 5-minute grid:
+#
+#   glucose[s, d, k]    reading of subject subjects[s] on day first_day[s] + d,
+#                       in the slot starting k * SLOT_SECONDS after midnight
+#
+# a subjects x days x SLOTS_PER_DAY array, days counted from each subject's
+# first day of readings and padded to the longest subject. Slots without a
+# reading are gaps: NaN in values(), GLUCOSE_MISSING in the uint16 array that
+# is stored (2 bytes a slot) and memory-mapped:
+#
+#   <grid_dir>/meta.json        {version, slot_seconds, missing, subjects,
+#                                first_day, collisions}
+#   <grid_dir>/glucose.npy
+#
+# A reading goes to the slot its timestamp falls in. When several readings
+# fall in the same slot, the earliest is kept and the others are dropped and
+# counted per subject in collisions; readings without a value are gaps.
+# Daily counts, moments, coverage and range counts are reductions over the
+# slot axis, and equal to those of metrics.py wherever no slot had a
+# collision and no reading was missing.
+
+VERSION = 1
+SLOT_SECONDS = 300
+SLOTS_PER_DAY = schema.SECONDS_PER_DAY // SLOT_SECONDS
+GLUCOSE_MISSING = arrays.GLUCOSE_MISSING
+# meta.json keys that mark a directory as an earlier grid
+META_KEYS = ('version', 'slot_seconds', 'subjects')
+
+
+class CGMGrid:
+
+    def __init__(self, subjects, first_day, glucose, collisions=None):
+        self.subjects = np.asarray(subjects, dtype=schema.SUBJECT_DTYPE)
+        self.first_day = np.asarray(first_day, dtype='int64')
+        self.glucose = glucose
+        self.collisions = collisions or {}
+
+    def days(self):
+        # subjects x days array of the day numbers (see schema.calendar_fields)
+        return self.first_day[:, None] + np.arange(self.glucose.shape[1])
+
+    def valid(self):
+        return self.glucose != GLUCOSE_MISSING
+
+    def values(self):
+        # float64 copy of the grid with NaN for gaps
+        values = self.glucose.astype('float64')
+        values[~self.valid()] = np.nan
+        return values
+
+    def readings(self):
+        # subjects x days count of readings
+        return self.valid().sum(axis=2)
+
+    def coverage(self):
+        # Fraction of each subject-day's slots that hold a reading
+        return self.readings() / SLOTS_PER_DAY
+
+    def moments(self):
+        # subjects x days reading counts, means and sample standard
+        # deviations, NaN where undefined. Gaps hold 0, so the sums run over
+        # the whole slot axis in float64 accumulators without a float64
+        # copy of the grid; they are sums of integers below 2**53, hence
+        # exact, and so is n * sum(x**2) - sum(x)**2.
+        readings = np.add.reduce(self.valid(), axis=2, dtype='int64')
+        total = np.add.reduce(self.glucose, axis=2, dtype='float64')
+        squares = np.einsum('...k,...k->...', self.glucose, self.glucose, dtype='float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / readings
+            std = np.sqrt((readings * squares - total ** 2) / (readings * (readings - 1.0)))
+        return readings, mean, std
+
+    def in_range(self, target_range=metrics.TARGET_RANGE):
+        # subjects x days count of readings within target_range (inclusive)
+        return (self.valid() & (self.glucose >= target_range[0]) & (self.glucose <= target_range[1])).sum(axis=2)
+
+    def range_counts(self, edges=metrics.RANGE_EDGES):
+        # subjects x days x bands count of readings in each glucose band
+        # (see metrics.classify_ranges). The valid slots of the uint16 grid
+        # are classified directly and counted with one bincount over
+        # (day, band), a subject at a time to bound the index arrays.
+        low_edges, high_edges = edges
+        n_bands = len(low_edges) + len(high_edges) + 1
+        counts = np.zeros(self.glucose.shape[:2] + (n_bands,), dtype='int64')
+        for s, glucose in enumerate(self.glucose):
+            valid = (glucose != GLUCOSE_MISSING).ravel()
+            values = glucose.ravel()[valid]
+            bands = np.digitize(values, low_edges, right=False) + np.digitize(values, high_edges, right=True)
+            days = np.flatnonzero(valid) // SLOTS_PER_DAY
+            counts[s] = np.bincount(bands + n_bands * days, minlength=counts[s].size).reshape(counts[s].shape)
+        return counts
+
+
+def build(cgm_df):
+    # CGMGrid of a canonical CGM table, subjects in order of first
+    # appearance
+    codes, subjects = pd.factorize(cgm_df['subject'], sort=False)
+    epoch = cgm_df['epoch'].to_numpy(dtype='int64')
+    glucose = arrays.to_array(cgm_df['mg/dl'], 'uint16')
+    day = epoch // schema.SECONDS_PER_DAY
+    first_day = pd.Series(day).groupby(codes).min().to_numpy() if len(day) else np.zeros(0, dtype='int64')
+    offset = day - first_day[codes]
+    days = int(offset.max()) + 1 if len(offset) else 0
+
+    # Seconds since the subject's first midnight, offset by subject, order
+    # the readings by subject and time in one sort; the first reading of
+    # each slot in that order is the earliest
+    keep = np.flatnonzero(glucose != GLUCOSE_MISSING)
+    seconds = (codes[keep] * days + offset[keep]) * schema.SECONDS_PER_DAY + epoch[keep] % schema.SECONDS_PER_DAY
+    order = np.argsort(seconds, kind='stable')
+    keep = keep[order]
+    cells = seconds[order] // SLOT_SECONDS
+    first = np.r_[True, cells[1:] != cells[:-1]][:len(cells)]
+    collisions = np.bincount(codes[keep[~first]], minlength=len(subjects))
+
+    grid = np.full(len(subjects) * days * SLOTS_PER_DAY, GLUCOSE_MISSING, dtype='uint16')
+    grid[cells[first]] = glucose[keep[first]]
+    return CGMGrid(np.asarray(subjects), first_day, grid.reshape(len(subjects), days, SLOTS_PER_DAY),
+                   {int(subject): int(n) for subject, n in zip(subjects, collisions) if n})
+
+
+def daily_table(grid, target_range=metrics.TARGET_RANGE):
+    # Table indexed by (subject, day) with the readings, mean, std and
+    # in_range of every subject-day with a reading, for
+    # metrics.daily_metrics_from
+    readings, mean, std = grid.moments()
+    subjects = np.broadcast_to(grid.subjects[:, None], readings.shape)
+    has = readings > 0
+    daily = pd.DataFrame({'subject': subjects[has], 'day': grid.days()[has].astype('int32'),
+                          'readings': readings[has], 'mean': mean[has], 'std': std[has],
+                          'in_range': grid.in_range(target_range)[has]})
+    return daily.set_index(['subject', 'day'])
+
+
+def daily_metrics(grid, min_readings=metrics.MIN_DAILY_READINGS, target_range=metrics.TARGET_RANGE):
+    # metrics.daily_metrics of the grid, subjects in grid order and days
+    # ascending; time in range is over the day's SLOTS_PER_DAY slots
+    return metrics.daily_metrics_from(daily_table(grid, target_range), min_readings, SLOTS_PER_DAY)
+
+
+def range_counts(grid, edges=metrics.RANGE_EDGES, names=None):
+    # metrics.range_counts of the grid: subjects (sorted) x bands
+    counts = grid.range_counts(edges).sum(axis=1)
+    if names is None:
+        names = metrics.RANGE_NAMES if counts.shape[1] == len(metrics.RANGE_NAMES) else \
+            ['band%d' % i for i in range(counts.shape[1])]
+    counts = pd.DataFrame(counts, index=pd.Index(grid.subjects, name='subject'), columns=names)
+    counts['readings'] = grid.readings().sum(axis=1)
+    return counts.sort_index()
+
+
+def time_in_ranges(grid, edges=metrics.RANGE_EDGES, names=None):
+    return metrics.range_percentages(range_counts(grid, edges, names))
+
+
+def write_grid(grid, grid_dir):
+    # Writes the grid to grid_dir, replacing an earlier grid there (see
+    # arrays.replace_dir)
+    return arrays.replace_dir(grid_dir, META_KEYS, lambda new_dir: _write_grid(grid, new_dir))
+
+
+def _write_grid(grid, grid_dir):
+    np.save(os.path.join(grid_dir, 'glucose.npy'), np.ascontiguousarray(grid.glucose))
+    meta = {'version': VERSION, 'slot_seconds': SLOT_SECONDS, 'missing': GLUCOSE_MISSING,
+            'subjects': grid.subjects.tolist(), 'first_day': grid.first_day.tolist(),
+            'collisions': {str(subject): n for subject, n in grid.collisions.items()}}
+    with open(os.path.join(grid_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def read_grid(grid_dir, mmap=True):
+    # CGMGrid of a grid directory, the array memory-mapped unless mmap is
+    # False
+    with open(os.path.join(grid_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('version') != VERSION or meta.get('slot_seconds') != SLOT_SECONDS:
+        raise ValueError("{} holds a grid of version {} with {} s slots, expected {} with {} s slots".format(
+            grid_dir, meta.get('version'), meta.get('slot_seconds'), VERSION, SLOT_SECONDS))
+    glucose = np.load(os.path.join(grid_dir, 'glucose.npy'), mmap_mode='r' if mmap else None)
+    return CGMGrid(meta['subjects'], meta['first_day'], glucose,
+                   {int(subject): n for subject, n in meta['collisions'].items()})
+
+
+def summary(grid):
+    readings = grid.readings()
+    lines = ["Grid of {} subjects x {} days x {} slots ({:.1f} MB), {} readings, {:.1f}% of the subjects' days' slots filled".format(
+        *grid.glucose.shape, grid.glucose.nbytes / 1e6, readings.sum(),
+        readings.sum() / max(1, (readings > 0).sum() * SLOTS_PER_DAY) * 100)]
+    for subject, n in grid.collisions.items():
+        lines.append("  Subject{}: {} readings shared a slot with an earlier one and were dropped".format(subject, n))
+    return "\n".join(lines)
+
+
+def export(dataset_path, grid_dir, workers=1):
+    arrays.check_replaceable(grid_dir, META_KEYS)
+    cohort = profiling.run('load cohort', ingest.load_cohort, dataset_path, {'CGM': ['mg/dl']}, workers)
+    print(cohort.summary())
+    grid = profiling.run('build grid', build, cohort.build('CGM'))
+    profiling.run('write grid', write_grid, grid, grid_dir)
+    print(summary(grid))
+    print("Wrote grid to " + grid_dir)
+
+
+def main(argv):
+    datadir_path = ''
+    grid_dir = ''
+    workers = 1
+    profile_path = None
+
+    usage = 'grid.py -d <path to dataset directory> -o <path to grid directory> [-w <number of workers>] [--profile <trace file>]'
+    if (len(argv) < 4):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:o:w:",["datasetDir=","gridDir=","workers=","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t grid.py -d ../dataset/ -o ../grid/')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-o", "--gridDir"):
+            grid_dir = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    print('Path to dataset directory is ' + datadir_path)
+    print('Path to grid directory is ' + grid_dir)
+    if profile_path:
+        profiling.start(profile_path, ['grid.py'] + argv)
+    export(datadir_path, grid_dir, workers)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
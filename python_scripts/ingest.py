@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+import schema
+import workbooks
+
+# Per-sheet counts load_subject reports alongside the frames
+COUNTS = ['fallback_rows', 'invalid_glucose', 'rounded_glucose']
+
+_cache = None
+
+def get_cache():
+    # One SheetCache per process so pool workers keep their byte accounting
+    # across the subjects they are handed.
+    global _cache
+    if _cache is None:
+        _cache = workbooks.SheetCache()
+    return _cache
+
+
+def load_subject(dataset_path, file, sheets):
+    # Load and normalize one subject workbook into the canonical schema (see
+    # schema.py). sheets maps each sheet name to the measurement columns the
+    # caller needs; the workbook is opened once for all of them. Returns
+    # ({sheet name: frame}, {sheet name: counts}), counts holding the
+    # timestamps that did not match schema.DATE_FORMAT (fallback_rows), the
+    # glucose cells made missing (invalid_glucose) and the fractional
+    # readings rounded (rounded_glucose), with None frames for sheets that
+    # could not be read (e.g. non-workbook files).
+    frames = dict.fromkeys(sheets)
+    counts = {sheet_name: dict.fromkeys(COUNTS, 0) for sheet_name in sheets}
+    subject = schema.subject_id(file)
+    if subject is None:
+        return frames, counts
+    try:
+        with profiling.stage('read sheets', subject) as record:
+            raw = workbooks.read_sheets(dataset_path + "/" + file,
+                                        {sheet_name: ['date'] + columns for sheet_name, columns in sheets.items()},
+                                        get_cache())
+            record['rows'] = sum(len(df) for df in raw.values() if df is not None)
+    except:
+        return frames, counts
+
+    for sheet_name, columns in sheets.items():
+        try:
+            df = raw[sheet_name]
+            with profiling.stage('parse timestamps', subject) as record:
+                df['time'], counts[sheet_name]['fallback_rows'] = schema.parse_timestamps(df['date'])
+                record['rows'] = len(df)
+            with profiling.stage('dedupe', subject) as record:
+                unique_df = df.drop_duplicates(subset=['time'])
+                new_df = unique_df.dropna(subset=['time'])
+                record['rows'] = len(new_df)
+            with profiling.stage('compact', subject) as record:
+                frames[sheet_name], invalid, rounded = schema.compact(new_df, subject, columns)
+                counts[sheet_name]['invalid_glucose'] = invalid
+                counts[sheet_name]['rounded_glucose'] = rounded
+                record['rows'] = len(frames[sheet_name])
+        except:
+            pass
+    return frames, counts
+
+
+def _load_subject_args(args):
+    # Pool worker: with profile set, the worker's stage records come back
+    # with the result for the parent's trace
+    *args, profile = args
+    if not profile:
+        return load_subject(*args), []
+    profiling.start()
+    result = load_subject(*args)
+    return result, profiling.collect()
+
+
+class CohortBuilder:
+    # Collects per-subject frames for each sheet and concatenates them once
+    # in build(), instead of growing a table with DataFrame.append (which
+    # copies everything accumulated so far on every subject).
+
+    def __init__(self, sheets):
+        self.frames = {sheet_name: [] for sheet_name in sheets}
+        self.ingested = []
+
+    def add(self, subject, frames, counts=None):
+        if counts is None:
+            counts = {}
+        for sheet_name, df in frames.items():
+            if df is None:
+                continue
+            self.frames[sheet_name].append(df)
+            sheet_counts = counts.get(sheet_name, {})
+            self.ingested.append((subject, sheet_name, len(df),
+                                  int(df.memory_usage(index=True, deep=True).sum()))
+                                 + tuple(sheet_counts.get(column, 0) for column in COUNTS))
+
+    def build(self, sheet_name):
+        frames = self.frames[sheet_name]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    def report(self):
+        # Rows and bytes ingested per subject and sheet, how many of the
+        # rows' timestamps needed format inference, and how many glucose
+        # cells were made missing or rounded
+        return pd.DataFrame(self.ingested, columns=['subject', 'sheet', 'rows', 'bytes'] + COUNTS)
+
+    def summary(self):
+        report = self.report()
+        lines = []
+        for sheet_name in self.frames:
+            sheet_report = report[report['sheet'] == sheet_name]
+            lines.append("{}: {} rows, {:.1f} MB from {} subjects".format(
+                sheet_name, sheet_report['rows'].sum(), sheet_report['bytes'].sum() / 1e6,
+                len(sheet_report)))
+            fallback = sheet_report[sheet_report['fallback_rows'] > 0]
+            for subject, rows in zip(fallback['subject'], fallback['fallback_rows']):
+                lines.append("  Subject{} {}: {} timestamps did not match '{}' and were inferred".format(
+                    subject, sheet_name, rows, schema.DATE_FORMAT))
+            invalid = sheet_report[sheet_report['invalid_glucose'] > 0]
+            for subject, rows in zip(invalid['subject'], invalid['invalid_glucose']):
+                lines.append("  Subject{} {}: {} glucose values were not readings within {}-{} mg/dL and were made missing".format(
+                    subject, sheet_name, rows, *schema.GLUCOSE_LIMITS))
+            rounded = sheet_report[sheet_report['rounded_glucose'] > 0]
+            for subject, rows in zip(rounded['subject'], rounded['rounded_glucose']):
+                lines.append("  Subject{} {}: {} fractional glucose readings were rounded to whole mg/dL".format(
+                    subject, sheet_name, rows))
+        return "\n".join(lines)
+
+
+def load_subjects(dataset_path, files, sheets, workers=1):
+    # load_subject results for files, in the order given whatever the worker
+    # count. workers=0 uses every available core.
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    jobs = [(dataset_path, file, sheets) for file in files]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(_load_subject_args, [job + (profiling.active(),) for job in jobs]))
+        for result, records in results:
+            profiling.add_records(records)
+        return [result for result, records in results]
+    return [load_subject(*job) for job in jobs]
+
+
+def load_cohort(dataset_path, sheets, workers=1):
+    # Returns a CohortBuilder filled in os.listdir order whatever the worker
+    # count, so the built tables are the same as for a serial run.
+    cleaned_files = os.listdir(dataset_path)
+    results = load_subjects(dataset_path, cleaned_files, sheets, workers)
+
+    cohort = CohortBuilder(sheets)
+    for file, (frames, counts) in zip(cleaned_files, results):
+        cohort.add(schema.subject_id(file), frames, counts)
+    return cohort
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+from time import perf_counter
+
+import aggregates
+import arrays
+import grid
+import ingest
+import metrics
+import profiling
+import pump
+import render
+import schema
+import shards
+import sketches
+import streaming
+import figure1
+import figure2
+import figure3
+import figure4
+import figure5
+
+# Every sheet and column any of the figures uses
+SHEETS = {'CGM': ['mg/dl'],
+          'Bolus': ['normal', 'carbInput', 'insulinCarbRatio'],
+          'Basal': ['rate']}
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args):
+        start = perf_counter()
+        result = profiling.run(name, func, *args)
+        self.stages.append((name, perf_counter() - start))
+        return result
+
+    def summary(self):
+        # Indented stages ran inside the stage above them and are left out
+        # of the total
+        width = max(len(name) for name, seconds in self.stages)
+        total = sum(seconds for name, seconds in self.stages if not name.startswith(' '))
+        lines = ["{:<{}}  {:>8.2f} s".format(name, width, seconds) for name, seconds in self.stages]
+        lines.append("{:<{}}  {:>8.2f} s".format('total', width, total))
+        return "\n".join(lines)
+
+
+def load_dataset(dataset_path, workers=1):
+    # CGM, Bolus and Basal tables of the whole cohort, read once
+    cohort = ingest.load_cohort(dataset_path, SHEETS, workers)
+    print(cohort.summary())
+    return cohort.build('CGM'), cohort.build('Bolus'), cohort.build('Basal')
+
+
+def load_arrays(array_dir):
+    # The same tables from an array directory written by arrays.py
+    cohort = arrays.ArrayStore(array_dir).cohort(SHEETS)
+    print(cohort.summary())
+    return cohort.build('CGM'), cohort.build('Bolus'), cohort.build('Basal')
+
+
+def load_subject_tables(dataset_path, subject):
+    # Figure 1 tables of one subject, read from its workbook alone
+    for file in os.listdir(dataset_path):
+        if schema.subject_id(file) == subject:
+            return figure1.setup_tables(os.path.join(dataset_path, file))
+    raise ValueError("No workbook for subject {} in {}".format(subject, dataset_path))
+
+
+def load_array_subject_tables(array_dir, subject):
+    # The same from an array directory
+    store = arrays.ArrayStore(array_dir)
+    if subject not in store.subjects():
+        raise ValueError("No arrays for subject {} in {}".format(subject, array_dir))
+    return tuple(store.table(subject, sheet_name) for sheet_name in SHEETS)
+
+
+def make_all(dataset_path, figure_dir, subject=31, workers=1, renderers=1, stats_only=False,
+             store_dir=None, array_dir=None, stream=False, use_sketches=False,
+             partial_path=None, use_grid=False):
+    # Aggregates every figure's data here, then draws the figures with the
+    # headless backend, renderers of them at a time in worker processes, or
+    # with stats_only writes the aggregates instead. With store_dir the
+    # aggregates come from an AggregateStore, which only reads the workbooks
+    # that are new or changed since the last run (plus figure 1's subject).
+    # With array_dir the cohort is read from memory-mapped arrays (see
+    # arrays.py) instead of the workbooks. With stream the aggregates are
+    # computed one subject at a time (see streaming.py) and the cohort
+    # tables are never built. With use_sketches the Figure 5 box statistics
+    # and the Figure 4 and 5 histograms come from per-subject quantile
+    # sketches (see sketches.py), which are also written to sketches.json;
+    # the aggregates keep them per subject, so only the in-memory path
+    # builds them here.
+    # With partial_path the aggregates are read from a partial or merged
+    # aggregate file (see shards.py). With use_grid the Figure 4 daily
+    # metrics and times in ranges are reductions of the cohort's 5-minute
+    # CGM grid (see grid.py); it only applies when the cohort tables are
+    # loaded.
+    timer = StageTimer()
+
+    if store_dir or stream or partial_path:
+        if partial_path:
+            tables, manifest = timer.run('read aggregates', shards.read_partial, partial_path)
+            print("Aggregates of {} workbooks from {}".format(len(manifest['files']), partial_path))
+            print(shards.missing_summary(manifest))
+        elif store_dir:
+            store = aggregates.AggregateStore(store_dir)
+            tables = timer.run('update aggregate store', store.update, dataset_path, workers)
+            print(store.summary())
+        elif array_dir:
+            tables = timer.run('stream aggregates', streaming.aggregate,
+                               streaming.array_subjects(arrays.ArrayStore(array_dir)))
+        else:
+            tables = timer.run('stream aggregates', streaming.aggregate, streaming.workbook_subjects(dataset_path))
+        if array_dir:
+            subject_tables = timer.run('load figure1 subject', load_array_subject_tables, array_dir, subject)
+        else:
+            subject_tables = timer.run('load figure1 subject', load_subject_tables, dataset_path, subject)
+
+        days_collected = timer.run('figure2 tables', figure2.days_collected_from, tables['coverage'])
+        pump_counts = timer.run('figure3 pump counts', figure3.pump_counts_from, tables['coverage'])
+        daily = tables['daily_metrics']
+        ranges = timer.run('figure4 time in ranges', metrics.range_percentages, tables['range_counts'])
+        totals = tables['daily_totals']
+        bolus_stats, carbs_stats = timer.run('figure5 box stats', figure5.boxplot_stats_from, tables['box_stats'])
+        stored_sketches = tables['sketches']
+    else:
+        if array_dir:
+            cgm_df, bolus_df, basal_df = timer.run('load arrays', load_arrays, array_dir)
+        else:
+            cgm_df, bolus_df, basal_df = timer.run('load dataset', load_dataset, dataset_path, workers)
+
+        days_collected = timer.run('figure2 tables', figure2.days_collected_table, cgm_df, bolus_df)
+        pump_counts = timer.run('figure3 pump counts', figure3.pump_counts, bolus_df)
+        if use_grid:
+            cgm_grid = timer.run('build cgm grid', grid.build, cgm_df)
+            print(grid.summary(cgm_grid))
+            daily = timer.run('figure4 daily metrics', grid.daily_metrics, cgm_grid)
+            ranges = timer.run('figure4 time in ranges', grid.time_in_ranges, cgm_grid)
+        else:
+            daily = timer.run('figure4 daily metrics', metrics.daily_metrics, cgm_df)
+            ranges = timer.run('figure4 time in ranges', metrics.time_in_ranges, cgm_df)
+        totals = timer.run('figure5 daily totals', pump.daily_totals, bolus_df)
+        if not use_sketches:
+            bolus_stats, carbs_stats = timer.run('figure5 box stats', figure5.boxplot_stats, bolus_df)
+        stored_sketches = None
+        subject_tables = (cgm_df[cgm_df['subject'] == subject],
+                          bolus_df[bolus_df['subject'] == subject],
+                          basal_df[basal_df['subject'] == subject])
+
+    daily_values = daily[['mean', 'cov', 'tir']]
+    total_values = totals[['bolus', 'carbs']]
+    daily_counts = total_counts = None
+    if use_sketches:
+        if stored_sketches is not None:
+            subject_sketches = timer.run('read sketches', sketches.table_sketches, stored_sketches)
+        else:
+            subject_sketches = timer.run('build sketches', sketches.subject_sketches,
+                                         {'daily_metrics': daily, 'daily_totals': totals, 'bolus': bolus_df})
+        sketches.write_sketches(subject_sketches, os.path.join(figure_dir, 'sketches.json'))
+        bolus_stats = sketches.box_stats(subject_sketches['bolus_dose'])
+        carbs_stats = sketches.box_stats(subject_sketches['carb_input'])
+        daily_values, daily_counts = sketches.histogram_values(subject_sketches, {'mean': 'daily_mean', 'cov': 'daily_cov',
+                                                                                  'tir': 'daily_tir'})
+        total_values, total_counts = sketches.histogram_values(subject_sketches, {'bolus': 'daily_bolus',
+                                                                                  'carbs': 'daily_carbs'})
+
+    if stats_only:
+        timer.run('figure2 stats', figure2.write_stats, days_collected, os.path.join(figure_dir, 'figure2.pdf'))
+        timer.run('figure3 stats', figure3.write_stats, pump_counts, os.path.join(figure_dir, 'figure3.pdf'))
+        timer.run('figure4 stats', figure4.write_stats, daily, ranges, figure_dir)
+        timer.run('figure5 stats', figure5.write_stats, totals, bolus_stats, carbs_stats, figure_dir)
+        timer.run('figure1 stats', figure1.write_stats, *subject_tables, os.path.join(figure_dir, 'figure1.pdf'))
+        print(timer.summary())
+        return
+
+    jobs = [('figure2', figure2.make_figure, (days_collected, os.path.join(figure_dir, 'figure2.pdf'))),
+            ('figure3', figure3.plot_figure, (pump_counts, os.path.join(figure_dir, 'figure3.pdf'))),
+            ('figure4 histograms', figure4.plot_histograms, (daily_values, figure_dir, daily_counts)),
+            ('figure4 ranges', figure4.plot_figure, (ranges, figure_dir)),
+            ('figure5 histograms', figure5.plot_histograms, (total_values, figure_dir, total_counts)),
+            ('figure5 boxplots', figure5.plot_boxplots, (bolus_stats, carbs_stats, figure_dir)),
+            ('figure1', figure1.make_figure, subject_tables + (os.path.join(figure_dir, 'figure1.pdf'),))]
+    rendered = timer.run('render figures', render.render, jobs, renderers)
+    for name, seconds in rendered:
+        timer.stages.append(('  ' + name, seconds))
+
+    print(timer.summary())
+
+
+def main(argv):
+    datadir_path = ''
+    figure_dir = ''
+    subject = 31
+    workers = 1
+    renderers = 1
+    stats_only = False
+    store_dir = None
+    array_dir = None
+    stream = False
+    use_sketches = False
+    partial_path = None
+    use_grid = False
+    profile_path = None
+
+    usage = 'make_all.py -d <path to dataset directory> -f <path to figure directory> [-s <figure 1 subject number>] [-w <number of workers>] [-r <number of render processes>] [-a <aggregate store directory>] [-m <array directory>] [--streaming] [-p <aggregate file>] [--sketches] [--grid] [--stats-only] [--profile <trace file>]'
+    if (len(argv) < 4):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:f:s:w:r:a:m:p:",["datasetDir=","figureDir=","subject=","workers=","renderers=","aggregates=","arrays=","aggregateFile=","streaming","sketches","grid","stats-only","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t make_all.py -d ../dataset/ -f ../Figures/ -s 31')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-f", "--figureDir"):
+            figure_dir = arg
+        elif opt in ("-s", "--subject"):
+            subject = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-r", "--renderers"):
+            renderers = int(arg)
+        elif opt in ("-a", "--aggregates"):
+            store_dir = arg
+        elif opt in ("-m", "--arrays"):
+            array_dir = arg
+        elif opt in ("-p", "--aggregateFile"):
+            partial_path = arg
+        elif opt == "--streaming":
+            stream = True
+        elif opt == "--sketches":
+            use_sketches = True
+        elif opt == "--grid":
+            use_grid = True
+        elif opt == "--stats-only":
+            stats_only = True
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    print('Path to dataset directory is ' + datadir_path)
+    print('Path to figure directory is ' + figure_dir)
+
+    if profile_path:
+        profiling.start(profile_path, ['make_all.py'] + argv)
+    make_all(datadir_path, figure_dir, subject, workers, renderers, stats_only, store_dir, array_dir, stream,
+             use_sketches, partial_path, use_grid)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+# A subject-day only counts when it has more than MIN_DAILY_READINGS CGM
+# readings; time in range is taken over at least READINGS_PER_DAY readings
+# (one every 5 minutes).
+MIN_DAILY_READINGS = 10
+READINGS_PER_DAY = 288
+TARGET_RANGE = (70, 180)
+
+# Consensus glucose ranges: < 54, 54-69, 70-180, 181-250 and > 250 mg/dL.
+# Edges below the target range open the band above them (x >= edge), edges
+# from the target range up close the band below them (x <= edge), so
+# ((54, 70), (180, 250)) reproduces the bounds above for any reading.
+RANGE_EDGES = ((54, 70), (180, 250))
+RANGE_NAMES = ['very_low', 'low', 'target', 'high', 'very_high']
+
+
+def daily_metrics(cbg_df, min_readings=MIN_DAILY_READINGS, readings_per_day=READINGS_PER_DAY,
+                  target_range=TARGET_RANGE):
+    # One row per (subject, day) with more than min_readings readings, in
+    # order of first appearance:
+    #   subject, day, readings, mean, std, cov, tir
+    # cov is std / mean and tir the percentage of max(readings_per_day,
+    # readings) that fell within target_range (inclusive).
+    glucose = schema.as_float(cbg_df['mg/dl'])
+    in_range = (glucose >= target_range[0]) & (glucose <= target_range[1])
+    grouped = pd.DataFrame({'subject': cbg_df['subject'].values,
+                            'day': cbg_df['day'].values,
+                            'mg/dl': glucose,
+                            'in_range': in_range})
+    grouped = grouped.groupby(['subject', 'day'], sort=False)
+
+    daily = grouped['mg/dl'].agg(['size', 'mean', 'std'])
+    daily['in_range'] = grouped['in_range'].sum()
+    daily = daily.rename(columns={'size': 'readings'})
+    return daily_metrics_from(daily, min_readings, readings_per_day)
+
+
+def daily_metrics_from(daily, min_readings=MIN_DAILY_READINGS, readings_per_day=READINGS_PER_DAY):
+    # daily_metrics from a table indexed by (subject, day) with the columns
+    # readings, mean, std and in_range
+    daily = daily[daily['readings'] > min_readings].copy()
+    daily['cov'] = daily['std'] / daily['mean']
+    daily['tir'] = daily['in_range'] / np.maximum(readings_per_day, daily['readings']) * 100
+    daily = daily.drop(columns=['in_range']).reset_index()
+    return daily
+
+
+def cohort_summary(cbg_df=None, bolus_df=None, min_readings=MIN_DAILY_READINGS):
+    # One row per subject (CGM subjects in order of first appearance, then
+    # pump-only subjects) with
+    #   readings, cgm_days, first_reading, last_reading     from cbg_df
+    #   bolus_events, pump_days, bolus_count, carb_count,
+    #   first_bolus, last_bolus                             from bolus_df
+    # cgm_days counts days with more than min_readings readings, pump_days
+    # counts days with any pump record, bolus_count and carb_count the
+    # records with a positive normal and carbInput. Timestamps are epoch
+    # seconds. Subjects missing from one table have NaN in its columns.
+    parts = []
+    if cbg_df is not None:
+        cgm = pd.DataFrame({'subject': cbg_df['subject'].values,
+                            'day': cbg_df['day'].values,
+                            'epoch': cbg_df['epoch'].values})
+        per_day = cgm.groupby(['subject', 'day'], sort=False).size()
+        cgm = cgm.groupby('subject', sort=False)['epoch'].agg(['size', 'min', 'max'])
+        cgm.columns = ['readings', 'first_reading', 'last_reading']
+        cgm.insert(1, 'cgm_days', (per_day > min_readings).groupby(level=0, sort=False).sum())
+        parts.append(cgm)
+
+    if bolus_df is not None:
+        pump = pd.DataFrame({'subject': bolus_df['subject'].values,
+                             'day': bolus_df['day'].values,
+                             'epoch': bolus_df['epoch'].values,
+                             'bolus': (bolus_df['normal'] > 0).values,
+                             'carb': (bolus_df['carbInput'] > 0).values})
+        pump = pump.groupby('subject', sort=False).agg(bolus_events=('epoch', 'size'),
+                                                       pump_days=('day', 'nunique'),
+                                                       bolus_count=('bolus', 'sum'),
+                                                       carb_count=('carb', 'sum'),
+                                                       first_bolus=('epoch', 'min'),
+                                                       last_bolus=('epoch', 'max'))
+        parts.append(pump)
+
+    summary = pd.concat(parts, axis=1)
+    summary.index.name = 'subject'
+    return summary
+
+
+def classify_ranges(glucose, edges=RANGE_EDGES):
+    # Band index (0 = lowest) of every reading in one vectorized pass; -1
+    # for missing readings.
+    glucose = schema.as_float(glucose)
+    low_edges, high_edges = edges
+    bands = np.digitize(glucose, low_edges, right=False)
+    bands += np.digitize(glucose, high_edges, right=True)
+    bands[np.isnan(glucose)] = -1
+    return bands
+
+
+def range_counts(cbg_df, edges=RANGE_EDGES, names=None):
+    # Subjects x bands matrix of reading counts (subjects sorted), plus a
+    # 'readings' column counting every reading of the subject, missing ones
+    # included, as the denominator for time in ranges.
+    n_bands = len(edges[0]) + len(edges[1]) + 1
+    if names is None:
+        names = RANGE_NAMES if n_bands == len(RANGE_NAMES) else ['band%d' % i for i in range(n_bands)]
+    codes, subjects = pd.factorize(cbg_df['subject'], sort=True)
+    bands = classify_ranges(cbg_df['mg/dl'], edges)
+    valid = bands >= 0
+
+    counts = np.bincount(codes[valid] * n_bands + bands[valid], minlength=len(subjects) * n_bands)
+    counts = pd.DataFrame(counts.reshape(len(subjects), n_bands), index=subjects, columns=names)
+    counts['readings'] = np.bincount(codes, minlength=len(subjects))
+    counts.index.name = 'subject'
+    return counts
+
+
+def time_in_ranges(cbg_df, edges=RANGE_EDGES, names=None):
+    # Percentage of each subject's readings in each band
+    return range_percentages(range_counts(cbg_df, edges, names))
+
+
+def range_percentages(counts):
+    # time_in_ranges from a range_counts table
+    counts = counts.copy()
+    readings = counts.pop('readings')
+    return counts.div(readings, axis=0) * 100
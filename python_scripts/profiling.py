@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import resource
+import tracemalloc
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+
+# Per-stage profiling behind every script's --profile <trace file>. Code
+# marks its stages with stage() or run(); while no profile is running they
+# cost next to nothing. A profiled run records for every stage its wall
+# time, rows produced, peak RSS and, for per-subject stages (workbook
+# decoding, timestamp parsing, dedupe, ...), the subject, and ends by
+# writing a JSON trace and printing a summary:
+#
+#   {"command", "seconds", "peak_rss_mb", "stage_peaks",
+#    "stages": [{"stage", "parent", "depth", "subject", "start", "seconds",
+#                "rows", "peak_rss_mb", "peak_traced_mb"}]}
+#
+# A stage's peak RSS is its own high-water mark, children included, where
+# the kernel can reset the mark (Linux, "stage_peaks": true); elsewhere it
+# is the process's peak so far. Environment variables add more detail:
+#
+#   DIATREND_PROFILE_TRACEMALLOC=1      peak Python heap per stage as well
+#                                       (tracemalloc; slows the run down)
+#   DIATREND_PROFILE_CPROFILE=<file>    cProfile statistics of the whole run,
+#                                       for python -m pstats or snakeviz
+
+_profiler = None
+
+
+def reset_peak_rss():
+    # Restarts the process's RSS high-water mark; False where unsupported
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def count_rows(result):
+    # Rows of a table, or of the tables in a tuple, None for anything else
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result)
+    if isinstance(result, tuple):
+        counts = [count_rows(item) for item in result]
+        return sum(counts) if counts and None not in counts else None
+    return None
+
+
+class Profiler:
+
+    def __init__(self, trace_path=None, command=None, trace_memory=False, cprofile_path=None):
+        self.trace_path = trace_path
+        self.command = command
+        self.trace_memory = trace_memory
+        self.cprofile_path = cprofile_path
+        self.records = []
+        self.stack = []
+        self.started = perf_counter()
+        self.stage_peaks = reset_peak_rss()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.cprofile = None
+        if cprofile_path:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def _peaks(self):
+        traced = tracemalloc.get_traced_memory()[1] / 2 ** 20 if self.trace_memory else None
+        return peak_rss_mb(), traced
+
+    def _reset_peaks(self):
+        reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+    def _fold_peaks(self, record, rss, traced):
+        record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0, rss)
+        if traced is not None:
+            record['peak_traced_mb'] = max(record['peak_traced_mb'] or 0, traced)
+
+    @contextmanager
+    def stage(self, name, subject=None):
+        parent = self.stack[-1] if self.stack else None
+        if parent is not None:
+            # The parent's peak so far, before the child restarts the mark
+            self._fold_peaks(parent, *self._peaks())
+        record = {'stage': name, 'parent': parent['stage'] if parent else None, 'depth': len(self.stack),
+                  'subject': subject, 'start': perf_counter() - self.started, 'seconds': None,
+                  'rows': None, 'peak_rss_mb': None, 'peak_traced_mb': None}
+        self._reset_peaks()
+        self.stack.append(record)
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = perf_counter() - start
+            self.stack.pop()
+            self._fold_peaks(record, *self._peaks())
+            if parent is not None:
+                self._fold_peaks(parent, record['peak_rss_mb'], record['peak_traced_mb'])
+            self.records.append(record)
+
+    def add_records(self, records):
+        # Records of another process (e.g. a pool worker) as children of the
+        # current stage, their start times counted from the stage's start
+        parent = self.stack[-1] if self.stack else None
+        offset = parent['start'] if parent else perf_counter() - self.started
+        for record in records:
+            record = dict(record, depth=record['depth'] + len(self.stack), start=offset + record['start'])
+            if record['parent'] is None and parent is not None:
+                record['parent'] = parent['stage']
+            self.records.append(record)
+
+    def trace(self):
+        peaks = [record['peak_rss_mb'] for record in self.records if record['peak_rss_mb'] is not None]
+        return {'command': self.command,
+                'seconds': perf_counter() - self.started,
+                'peak_rss_mb': max(peaks + [peak_rss_mb()]),
+                'stage_peaks': self.stage_peaks,
+                'stages': sorted(self.records, key=lambda record: record['start'])}
+
+    def summary(self):
+        # Stages in order, indented by depth; per-subject stages summed
+        # over the subjects
+        trace = self.trace()
+        stages = [record for record in trace['stages'] if record['subject'] is None]
+        per_subject = pd.DataFrame([record for record in trace['stages'] if record['subject'] is not None],
+                                   columns=['stage', 'subject', 'seconds', 'rows', 'peak_rss_mb'])
+        grouped = per_subject.groupby('stage', sort=False)
+        subjects = pd.DataFrame({'subjects': grouped['subject'].nunique(),
+                                 'seconds': grouped['seconds'].sum(),
+                                 'slowest': grouped['seconds'].max(),
+                                 'peak_rss_mb': grouped['peak_rss_mb'].max(),
+                                 'rows': grouped['rows'].sum(min_count=1)})
+
+        names = ['  ' * record['depth'] + record['stage'] for record in stages] + ['  ' + name for name in subjects.index]
+        width = max([len(name) for name in names] + [len('per subject')])
+        line = "{:<{}}  {:>9.3f} s  {:>12}  {:>10}"
+        megabytes = lambda value: '' if value is None or pd.isna(value) else '{:.1f} MB'.format(value)
+        count = lambda value: '' if value is None or pd.isna(value) else int(value)
+        lines = []
+        for name, record in zip(names, stages):
+            lines.append(line.format(name, width, record['seconds'], megabytes(record['peak_rss_mb']),
+                                     count(record['rows'])))
+        if len(subjects):
+            lines.append('per subject')
+        for name, row in subjects.iterrows():
+            lines.append(line.format('  ' + name, width, row['seconds'], megabytes(row['peak_rss_mb']),
+                                     count(row['rows']))
+                         + "  {} subjects, slowest {:.3f} s".format(int(row['subjects']), row['slowest']))
+        lines.append(line.format('total', width, trace['seconds'], megabytes(trace['peak_rss_mb']), ''))
+        return "\n".join(lines)
+
+    def finish(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            print("Wrote cProfile statistics to " + self.cprofile_path)
+        if self.trace_path:
+            with open(self.trace_path, 'w') as f:
+                json.dump(self.trace(), f, indent=1)
+            print(self.summary())
+            print("Wrote profile trace to " + self.trace_path)
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def start(trace_path=None, command=None):
+    # Starts profiling this process; trace_path None only collects records
+    # (see collect)
+    global _profiler
+    _profiler = Profiler(trace_path, command,
+                         trace_memory=os.environ.get('DIATREND_PROFILE_TRACEMALLOC', '') not in ('', '0'),
+                         cprofile_path=os.environ.get('DIATREND_PROFILE_CPROFILE') if trace_path else None)
+    return _profiler
+
+
+def active():
+    return _profiler is not None
+
+
+def stage(name, subject=None):
+    # Context manager timing a stage; the record it yields takes 'rows'
+    if _profiler is None:
+        return nullcontext({})
+    return _profiler.stage(name, subject)
+
+
+def run(name, func, *args, **kwargs):
+    # func(*args, **kwargs) as a stage, counting the rows of its result
+    with stage(name) as record:
+        result = func(*args, **kwargs)
+        record['rows'] = count_rows(result)
+    return result
+
+
+def record(name, seconds, rows=None, subject=None):
+    # A stage timed elsewhere, e.g. in a worker process; its start is when
+    # it is recorded
+    if _profiler is not None:
+        _profiler.add_records([{'stage': name, 'parent': None, 'depth': 0, 'subject': subject,
+                                'start': 0.0, 'seconds': seconds, 'rows': rows,
+                                'peak_rss_mb': None, 'peak_traced_mb': None}])
+
+
+def add_records(records):
+    if _profiler is not None:
+        _profiler.add_records(records)
+
+
+def collect():
+    # Stops profiling and returns the records, e.g. to send them from a
+    # worker process to add_records in its parent
+    global _profiler
+    records = _profiler.records if _profiler is not None else []
+    _profiler = None
+    return records
+
+
+def finish():
+    # Stops profiling, writing the trace and printing the summary
+    global _profiler
+    if _profiler is not None:
+        _profiler.finish()
+    _profiler = None
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+
+# Whiskers reach the most extreme value within WHISKER_IQR * IQR of the
+# box, the same rule as matplotlib/seaborn boxplots.
+WHISKER_IQR = 1.5
+# Bolus columns whose positive values get box statistics (Figure 5)
+BOXED = ['normal', 'carbInput']
+BOX_COLUMNS = ['column', 'subject', 'med', 'q1', 'q3', 'whislo', 'whishi', 'fliers']
+
+
+def daily_totals(bolus_df):
+    # One row per (subject, day) in order of first appearance with the day's
+    # total bolus insulin (units) and carb input (g).
+    totals = pd.DataFrame({'subject': bolus_df['subject'].values,
+                           'day': bolus_df['day'].values,
+                           'bolus': bolus_df['normal'].values,
+                           'carbs': bolus_df['carbInput'].values})
+    totals = totals.groupby(['subject', 'day'], sort=False)[['bolus', 'carbs']].sum()
+    return totals.reset_index()
+
+
+def box_stats(df, column, subject_column='subject', whis=WHISKER_IQR):
+    # Per-subject boxplot statistics of df[column], ordered by subject, as a
+    # list of dicts that matplotlib's Axes.bxp draws directly:
+    #   label, med, q1, q3, whislo, whishi, fliers
+    values = pd.DataFrame({'subject': df[subject_column].values,
+                           'value': df[column].values}).dropna()
+    grouped = values.groupby('subject')['value']
+    quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    quartiles.columns = ['q1', 'med', 'q3']
+
+    iqr = quartiles['q3'] - quartiles['q1']
+    lo = (quartiles['q1'] - whis * iqr).reindex(values['subject']).values
+    hi = (quartiles['q3'] + whis * iqr).reindex(values['subject']).values
+    inside = (values['value'].values >= lo) & (values['value'].values <= hi)
+
+    within = values[inside].groupby('subject')['value']
+    quartiles['whislo'] = np.minimum(within.min(), quartiles['q1'])
+    quartiles['whishi'] = np.maximum(within.max(), quartiles['q3'])
+    fliers = values[~inside].groupby('subject')['value'].apply(np.asarray)
+
+    stats = []
+    for subject, row in quartiles.iterrows():
+        stats.append({'label': subject,
+                      'med': row['med'],
+                      'q1': row['q1'],
+                      'q3': row['q3'],
+                      'whislo': row['whislo'],
+                      'whishi': row['whishi'],
+                      'fliers': fliers.get(subject, np.array([]))})
+    return stats
+
+
+def box_stats_table(bolus_df, columns=BOXED, whis=WHISKER_IQR):
+    # box_stats of the positive values of each of columns as one table, a
+    # row per (column, subject) with the columns BOX_COLUMNS and the fliers
+    # as a list, so per-subject box statistics can be stored and
+    # concatenated instead of the events behind them
+    rows = []
+    for column in columns:
+        for stats in box_stats(bolus_df[bolus_df[column] > 0], column, whis=whis):
+            rows.append([column, stats['label'], stats['med'], stats['q1'], stats['q3'],
+                         stats['whislo'], stats['whishi'], stats['fliers'].tolist()])
+    return pd.DataFrame(rows, columns=BOX_COLUMNS)
+
+
+def box_stats_from(table, column):
+    # box_stats of column back from (concatenated) box_stats_table rows,
+    # ordered by subject
+    rows = table[table['column'] == column].sort_values('subject', kind='stable')
+    return [{'label': row.subject,
+             'med': row.med,
+             'q1': row.q1,
+             'q3': row.q3,
+             'whislo': row.whislo,
+             'whishi': row.whishi,
+             'fliers': np.asarray(row.fliers, dtype=float)}
+            for row in rows.itertuples(index=False)]
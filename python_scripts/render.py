@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import os
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+
+# Figure rendering jobs are (name, plot function, arguments) tuples. The plot
+# functions are the figure modules' plot_* / make_figure functions and take
+# only the small per-subject or per-day aggregates their figure shows, so a
+# worker process is sent kilobytes, never the cohort tables.
+
+HEADLESS_BACKEND = 'Agg'
+
+
+def use_headless_backend():
+    # Must run before matplotlib.pyplot is imported to take effect in a
+    # fresh process; worker processes inherit MPLBACKEND either way.
+    os.environ['MPLBACKEND'] = HEADLESS_BACKEND
+    import matplotlib
+    matplotlib.use(HEADLESS_BACKEND)
+
+
+def render_job(job):
+    # Draws one figure from the rc settings of the matplotlibrc file, so a
+    # figure looks the same whichever process and job order drew it, and
+    # closes it afterwards. Returns (name, seconds).
+    import matplotlib
+    import matplotlib.pyplot as plt
+    name, func, args = job
+    start = perf_counter()
+    with profiling.stage(name):
+        matplotlib.rc_file_defaults()
+        func(*args)
+        plt.close('all')
+    return name, perf_counter() - start
+
+
+def render(jobs, workers=1):
+    # Runs the jobs with the headless backend, on a pool of worker processes
+    # when workers > 1 (0 uses every available core), so the wall time is
+    # about that of the slowest figure. Returns [(name, seconds)] in job
+    # order; a profiled run records the workers' timings as stages.
+    use_headless_backend()
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                                 initializer=use_headless_backend) as pool:
+            rendered = list(pool.map(render_job, jobs))
+        for name, seconds in rendered:
+            profiling.record(name, seconds)
+        return rendered
+    return [render_job(job) for job in jobs]
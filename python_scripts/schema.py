@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+import re
+import numpy as np
+import pandas as pd
+
+# Canonical in-memory layout of the CGM, Bolus and Basal tables, one row
+# per record:
+#
+#   subject   int16    number of the SubjectNN workbook
+#   epoch     int64    seconds since 1970-01-01 00:00 UTC
+#   day       int32    days since 1970-01-01 (the record's UTC date)
+#   weekday   int8     0 = Monday ... 6 = Sunday
+#   week      int8     week of the year with weeks starting on Monday,
+#                      as strftime('%W')
+#   minute    int16    minute of the day
+#
+# followed by the sheet's measurement columns: mg/dl as nullable UInt16
+# (readings rounded to whole mg/dL, missing readings kept as <NA>), pump
+# columns (normal, carbInput, insulinCarbRatio, rate) as float64.
+#
+# Glucose cells that are not numbers or fall outside GLUCOSE_LIMITS once
+# rounded become <NA>; compact() counts them, and the fractional readings it
+# rounded, so loaders can report both.
+
+SUBJECT_DTYPE = 'int16'
+GLUCOSE_DTYPE = 'UInt16'
+# Whole mg/dL a UInt16 reading can hold; 0 is left out as it marks gaps in
+# the stored arrays (see arrays.GLUCOSE_MISSING)
+GLUCOSE_LIMITS = (1, 65535)
+VALUE_DTYPES = {'mg/dl': GLUCOSE_DTYPE}
+CALENDAR_COLUMNS = ['day', 'weekday', 'week', 'minute']
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+SECONDS_PER_DAY = 86400
+
+# Layout of date cells stored as text. Cells Excel already stores as dates
+# need no parsing at all.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def subject_id(name):
+    # 31 for 'Subject31.xlsx'; None when the name carries no number
+    match = re.search(r'(\d+)', name)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def parse_timestamps(values, date_format=DATE_FORMAT):
+    # UTC timestamps from a raw date column, parsed once with date_format.
+    # Only values that do not match it fall back to per-value format
+    # inference. Returns (timestamps, number of values that needed the
+    # fallback); values that cannot be parsed at all become NaT.
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return pd.to_datetime(values, utc=True), 0
+    parsed = pd.to_datetime(values, format=date_format, utc=True, errors='coerce')
+    fallback = parsed.isna() & values.notna()
+    n_fallback = int(fallback.sum())
+    if n_fallback:
+        inferred = values[fallback].map(lambda v: pd.to_datetime(v, utc=True, errors='coerce'))
+        parsed[fallback] = pd.to_datetime(inferred, utc=True)
+    return parsed, n_fallback
+
+
+def epoch_seconds(times):
+    # int64 seconds since the epoch from a datetime Series; tz-naive times
+    # are taken as UTC
+    times = pd.Series(times)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert('UTC').dt.tz_localize(None)
+    return ((times - pd.Timestamp(0)) // pd.Timedelta(seconds=1)).astype('int64')
+
+
+def year_of(day):
+    # Calendar year of each day number (proleptic Gregorian, after
+    # H. Hinnant's civil_from_days)
+    z = day + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    return yoe + era * 400 + (mp >= 10)
+
+
+def first_day(year):
+    # Day number of January 1st of each year (days_from_civil)
+    y = year - 1
+    era = y // 400
+    yoe = y - era * 400
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + 306 - 719468
+
+
+def year_start(day):
+    # Day number of January 1st of the year containing each day number
+    return first_day(year_of(day))
+
+
+def week_day(year, week, weekday):
+    # Day number of the given weekday (0 = Monday) of the given week of the
+    # year, weeks numbered as in calendar_fields
+    start = first_day(year)
+    first_monday = start + (7 - (start + 3) % 7) % 7
+    return first_monday + (week - 1) * 7 + weekday
+
+
+def calendar_fields(epoch):
+    # day, weekday, week and minute columns computed from epoch seconds
+    epoch = np.asarray(epoch, dtype='int64')
+    day = epoch // SECONDS_PER_DAY
+    weekday = (day + 3) % 7
+    week = (day - year_start(day) + 7 - weekday) // 7
+    minute = (epoch - day * SECONDS_PER_DAY) // 60
+    return {'day': day.astype('int32'),
+            'weekday': weekday.astype('int8'),
+            'week': week.astype('int8'),
+            'minute': minute.astype('int16')}
+
+
+def to_datetime(epoch):
+    # Naive datetimes (UTC wall clock) for plotting
+    return pd.to_datetime(np.asarray(epoch, dtype='int64'), unit='s')
+
+
+def as_float(values):
+    # float64 array from a possibly nullable column, <NA> as NaN
+    return pd.Series(values).to_numpy(dtype=float, na_value=np.nan)
+
+
+def glucose_values(values, limits=GLUCOSE_LIMITS):
+    # Whole mg/dL readings from a raw glucose column, as float64 with NaN
+    # for missing ones. Returns (readings, number of non-empty values that
+    # were not numbers or fell outside limits and became NaN, number of
+    # fractional readings that were rounded).
+    values = pd.Series(values)
+    numbers = pd.to_numeric(values, errors='coerce').astype('float64')
+    rounded = numbers.round()
+    invalid = values.notna() & ~rounded.between(*limits)
+    n_rounded = int(((rounded != numbers) & numbers.notna() & ~invalid).sum())
+    return rounded.mask(invalid), int(invalid.sum()), n_rounded
+
+
+def compact(df, subject, columns, time_column='time'):
+    # Canonical table from a normalized sheet whose time_column holds parsed
+    # timestamps. columns lists the measurement columns to keep; those the
+    # sheet lacks are filled with missing values. The index is preserved.
+    # Returns (table, glucose cells made missing, glucose readings rounded),
+    # see glucose_values.
+    epoch = epoch_seconds(df[time_column]).values
+    table = {'subject': np.full(len(df), subject, dtype=SUBJECT_DTYPE),
+             'epoch': epoch}
+    table.update(calendar_fields(epoch))
+    n_invalid = n_rounded = 0
+    for column in columns:
+        dtype = VALUE_DTYPES.get(column, 'float64')
+        if column in df.columns:
+            values = df[column]
+        else:
+            values = pd.Series(np.nan, index=df.index)
+        if dtype == GLUCOSE_DTYPE:
+            values, invalid, rounded = glucose_values(values)
+            n_invalid += invalid
+            n_rounded += rounded
+        else:
+            values = pd.to_numeric(values, errors='coerce')
+        table[column] = values.astype(dtype).values
+    return pd.DataFrame(table, index=df.index), n_invalid, n_rounded
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+
+# Step functions from event series, e.g. basal rates or insulin-to-carb
+# ratios: every event sets the value from its time until the next event with
+# a different value. The segments of one series, or of a whole cohort with
+# one series per group (subject), come out of a single vectorized pass.
+
+
+def step_segments(times, values, start=None, end=None, seed=None, groups=None):
+    # One row per run of equal values with columns start, end and value, plus
+    # group when groups is given. times must be ascending within each group
+    # and each group's events contiguous, as in TimeIndex tables. Events with
+    # a missing value are skipped.
+    #
+    # With start and seed every series begins with the value seed at start
+    # (the value in effect before its first event). end closes each series'
+    # last segment; by default it ends at the series' last event.
+    times = np.asarray(times)
+    values = np.asarray(values, dtype=float)
+    grouped = groups is not None
+    groups = np.asarray(groups) if grouped else np.zeros(len(times), dtype=int)
+
+    if start is not None and seed is not None and not pd.isna(seed):
+        first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else np.zeros(0, dtype=int)
+        if not grouped and not len(times):
+            first = np.zeros(1, dtype=int)
+            groups = np.zeros(1, dtype=int)
+        else:
+            groups = np.insert(groups, first, groups[first])
+        times = np.insert(times, first, start)
+        values = np.insert(values, first, seed)
+
+    valid = ~np.isnan(values)
+    times, values, groups = times[valid], values[valid], groups[valid]
+    first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else np.zeros(0, dtype=int)
+
+    # A segment starts at each series' first event and wherever the value
+    # changes; it ends where the next one starts, or at end / the series'
+    # last event
+    new_series = np.zeros(len(times), dtype=bool)
+    new_series[first] = True
+    change = new_series.copy()
+    change[1:] |= values[1:] != values[:-1]
+    last_event = np.r_[new_series[1:], True][:len(times)]
+
+    starts = times[change]
+    ends = np.r_[starts[1:], starts[:1]]
+    series_end = change.cumsum()[np.r_[first[1:] - 1, len(times) - 1]] - 1 if len(times) else first
+    ends[series_end] = times[last_event] if end is None else end
+
+    segments = pd.DataFrame({'start': starts, 'end': ends, 'value': values[change]})
+    if grouped:
+        segments.insert(0, 'group', groups[change])
+    return segments
+
+
+def step_points(segments):
+    # x and y of the corner points of a step line through the segments of
+    # one series: each value from its segment's start to the next start, the
+    # last one up to its end
+    starts = segments['start'].to_numpy()
+    values = segments['value'].to_numpy()
+    if not len(starts):
+        return starts, values
+    x = np.r_[starts[:1], np.repeat(starts[1:], 2), segments['end'].to_numpy()[-1:]]
+    y = np.repeat(values, 2)
+    return x, y
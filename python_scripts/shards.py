@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+import aggregates
+import profiling
+import schema
+import sketches
+import streaming
+
+# Aggregates of a cohort split across machines. Each node writes a partial
+# file with the aggregate tables (see aggregates.py) of its subjects, and
+# merging any number of partial files gives the tables a single run over
+# every subject would, ready for make_all.py -p:
+#
+#   {"version", "settings": aggregates.settings(), "files": [workbooks],
+#    "cohort": [every workbook of the cohort], "shards": number of shards,
+#    "indices": [shard indices held],
+#    "tables": {table: {"columns": {column: [values]}, "dtypes": {column: dtype}}}}
+#
+# Shards are contiguous slices of the sorted directory listing, so every
+# node assigns the same workbooks to the same shard whatever order its file
+# system lists them in.
+#
+# The tables are the daily metrics, coverage (day and record counts), range
+# count matrix, daily pump totals, pump box statistics and quantile sketches
+# of the subjects, never their records. Floats are written with repr, so
+# they read back exactly. A merged file has the same format and can be merged again.
+# Partials must come from the same settings, cohort and number of shards and
+# hold disjoint sets of subjects. They can be merged in any order: the rows
+# come out in the order of the cohort listing, as in a single run, and the
+# shards and workbooks no partial holds are reported.
+
+VERSION = 3
+
+
+def shard_files(dataset_path, shards=1, index=0):
+    # The files of shard index of shards: a contiguous slice of the sorted
+    # directory listing
+    files = sorted(os.listdir(dataset_path))
+    size = -(-len(files) // shards)
+    return files[index * size:(index + 1) * size]
+
+
+def _table_data(df):
+    return {'columns': {str(column): df[column].tolist() for column in df},
+            'dtypes': {str(column): str(dtype) for column, dtype in df.dtypes.items()}}
+
+
+def _table_frame(data):
+    return pd.DataFrame(data['columns'], columns=list(data['columns'])).astype(data['dtypes'])
+
+
+def write_partial(tables, manifest, path):
+    # Writes merged aggregate tables with their manifest: the files, cohort,
+    # shards and indices entries described above
+    data = {}
+    for name in aggregates.TABLES:
+        df = tables[name]
+        if name in aggregates.INDEXED_TABLES and df.index.name == 'subject':
+            df = df.reset_index()
+        data[name] = _table_data(df)
+
+    tmp = path + '.%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(dict(manifest, version=VERSION, settings=aggregates.settings(), tables=data), f)
+    os.replace(tmp, path)
+    print("Wrote " + path)
+
+
+def read_partial(path):
+    # (tables, manifest) of a partial or merged file
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != VERSION:
+        raise ValueError("{} holds aggregates of version {}, expected {}".format(path, data.get('version'), VERSION))
+    if data['settings'] != aggregates.settings():
+        raise ValueError("{} was computed with different settings: {}".format(path, data['settings']))
+
+    tables = {}
+    for name in aggregates.TABLES:
+        df = _table_frame(data['tables'][name])
+        if name in aggregates.INDEXED_TABLES and 'subject' in df:
+            df = df.set_index('subject')
+        tables[name] = df
+    return tables, {key: data[key] for key in ['files', 'cohort', 'shards', 'indices']}
+
+
+def missing(manifest):
+    # (shard indices, cohort workbooks) a partial or merged file lacks
+    indices = sorted(set(range(manifest['shards'])) - set(manifest['indices']))
+    files = [file for file in manifest['cohort'] if file not in set(manifest['files'])]
+    return indices, files
+
+
+def missing_summary(manifest):
+    indices, files = missing(manifest)
+    if not indices and not files:
+        return "All {} shards and {} workbooks of the cohort present".format(manifest['shards'], len(manifest['cohort']))
+    lines = ["Missing {} of {} shards {} and {} of {} workbooks".format(
+        len(indices), manifest['shards'], indices, len(files), len(manifest['cohort']))]
+    for file in files:
+        lines.append("  " + file)
+    return "\n".join(lines)
+
+
+def compute_partial(dataset_path, path, shards=1, index=0):
+    # Aggregates the workbooks of shard index of shards, one at a time, into
+    # a partial file
+    files = shard_files(dataset_path, shards, index)
+    manifest = {'files': files, 'cohort': os.listdir(dataset_path), 'shards': shards, 'indices': [index]}
+    tables = profiling.run('aggregate shard', streaming.aggregate, streaming.workbook_subjects(dataset_path, files))
+    profiling.run('write partial', write_partial, tables, manifest, path)
+    return path
+
+
+def _compute_partial_args(args):
+    # Pool worker: with profile set, the worker's stage records come back
+    # with the path for the parent's trace
+    *args, profile = args
+    if not profile:
+        return compute_partial(*args), []
+    profiling.start()
+    path = compute_partial(*args)
+    return path, profiling.collect()
+
+
+def subject_tables(tables):
+    # {subject: that subject's rows of each of the merged aggregate tables}
+    per_subject = {}
+    for name, df in tables.items():
+        if not len(df):
+            continue
+        subjects = df.index if name in aggregates.INDEXED_TABLES else df['subject']
+        for subject, rows in df.groupby(subjects.to_numpy(), sort=False):
+            per_subject.setdefault(int(subject), {})[name] = rows
+    return per_subject
+
+
+def merge_partials(paths):
+    # (tables, manifest) of several partial files together, the subjects in
+    # the order of the cohort listing
+    parts = [profiling.run('read partial', read_partial, path) for path in paths]
+    cohort, shards = parts[0][1]['cohort'], parts[0][1]['shards']
+    subjects = {}
+    indices = set()
+    for path, (tables, manifest) in zip(paths, parts):
+        if sorted(manifest['cohort']) != sorted(cohort) or manifest['shards'] != shards:
+            raise ValueError("{} is a shard of another cohort or split ({} shards of {} workbooks, expected {} of {})".format(
+                path, manifest['shards'], len(manifest['cohort']), shards, len(cohort)))
+        if indices & set(manifest['indices']):
+            raise ValueError("{} repeats shards {}".format(path, sorted(indices & set(manifest['indices']))))
+        indices |= set(manifest['indices'])
+        shard_subjects = subject_tables(tables)
+        if shard_subjects.keys() & subjects.keys():
+            raise ValueError("{} repeats subjects {}".format(path, sorted(shard_subjects.keys() & subjects.keys())))
+        subjects.update(shard_subjects)
+
+    order = {schema.subject_id(file): position for position, file in enumerate(cohort)}
+    ordered = sorted(subjects, key=lambda subject: order.get(subject, len(order)))
+    merged = profiling.run('merge partials', aggregates.merge, [subjects[subject] for subject in ordered])
+    merged['sketches'] = sketches.sketch_table(sketches.merge_sketches(
+        [sketches.table_sketches(tables['sketches']) for tables, manifest in parts]))
+    files = set(file for tables, manifest in parts for file in manifest['files'])
+    manifest = {'files': [file for file in cohort if file in files], 'cohort': cohort, 'shards': shards,
+                'indices': sorted(indices)}
+    return merged, manifest
+
+
+def merge_files(paths, output):
+    tables, manifest = merge_partials(paths)
+    print(missing_summary(manifest))
+    profiling.run('write partial', write_partial, tables, manifest, output)
+
+
+def run_local(dataset_path, output, shards, workers=None):
+    # Stand-in for a multi-node run: every shard of dataset_path is
+    # aggregated into <output stem>.part<i>.json by its own process, then
+    # the partial files are merged into output
+    stem = os.path.splitext(output)[0]
+    jobs = [(dataset_path, '{}.part{}.json'.format(stem, index), shards, index, profiling.active())
+            for index in range(shards)]
+    with profiling.stage('compute shards'):
+        with ProcessPoolExecutor(max_workers=workers or shards) as pool:
+            results = list(pool.map(_compute_partial_args, jobs))
+        for path, records in results:
+            profiling.add_records(records)
+    merge_files([path for path, records in results], output)
+
+
+def main(argv):
+    datadir_path = ''
+    output = ''
+    shards = 1
+    index = 0
+    merge = False
+    local = 0
+    profile_path = None
+
+    usage = ('shards.py -d <path to dataset directory> -o <partial file> [-n <number of shards> -i <shard index>]\n'
+             '\t shards.py -o <merged file> --merge <partial file> [<partial file> ...]\n'
+             '\t shards.py -d <path to dataset directory> -o <merged file> --local <number of shards>\n'
+             '\t add --profile <trace file> to any of them to profile the run')
+    if (len(argv) < 3):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:o:n:i:",["datasetDir=","output=","shards=","index=","merge","local=","profile="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t shards.py -d ../dataset/ -o ../aggregates/part0.json -n 2 -i 0')
+            sys.exit()
+        elif opt in ("-d", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-n", "--shards"):
+            shards = int(arg)
+        elif opt in ("-i", "--index"):
+            index = int(arg)
+        elif opt == "--merge":
+            merge = True
+        elif opt == "--local":
+            local = int(arg)
+        elif opt == "--profile":
+            profile_path = arg
+        else:
+            print(usage)
+
+    if profile_path:
+        profiling.start(profile_path, ['shards.py'] + argv)
+    if merge:
+        merge_files(args, output)
+    elif local:
+        run_local(datadir_path, output, local)
+    else:
+        compute_partial(datadir_path, output, shards, index)
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+import json
+import numpy as np
+import pandas as pd
+
+import pump
+import schema
+
+# Mergeable quantile sketches of per-subject distributions, so box
+# statistics and histograms can be drawn from compact summaries instead of
+# every event. A QuantileSketch counts non-negative values in logarithmic
+# buckets (a DDSketch): bucket k holds the values in (gamma^(k-1), gamma^k]
+# with gamma = (1 + alpha) / (1 - alpha), and stands for them by a value
+# within relative error alpha of each. Hence
+#
+#   every quantile and box statistic is within ALPHA (relative) of the exact
+#   one, and so is every value behind a histogram (a value within ALPHA of a
+#   bin edge may be counted in the neighboring bin);
+#   count, sum, min and max are exact;
+#   merging two sketches adds their bucket counts, so it is exact too and
+#   sketches of shards merge into the sketch of the whole cohort.
+#
+# The sketches kept per subject, as (aggregate table or 'bolus' for the
+# Bolus records, column, positive values only), see aggregates.py:
+SKETCHED = {'bolus_dose': ('bolus', 'normal', True),
+            'carb_input': ('bolus', 'carbInput', True),
+            'daily_bolus': ('daily_totals', 'bolus', False),
+            'daily_carbs': ('daily_totals', 'carbs', False),
+            'daily_mean': ('daily_metrics', 'mean', False),
+            'daily_cov': ('daily_metrics', 'cov', False),
+            'daily_tir': ('daily_metrics', 'tir', False)}
+ALPHA = 0.005
+VERSION = 1
+# Columns of a sketch_table: one row per (sketch name, subject)
+SKETCH_COLUMNS = ['sketch', 'subject', 'alpha', 'count', 'sum', 'min', 'max', 'zeros', 'keys', 'counts']
+
+
+class QuantileSketch:
+
+    def __init__(self, alpha=ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        # Counts values; missing ones are skipped
+        values = schema.as_float(values)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        if values.min() < 0:
+            raise ValueError("QuantileSketch only takes non-negative values")
+        positive = values[values > 0]
+        keys, counts = np.unique(np.ceil(np.log(positive) / np.log(self.gamma)).astype('int64'),
+                                 return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += len(values) - len(positive)
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        return self
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches of alpha {} and {}".format(self.alpha, other.alpha))
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def values(self):
+        # (values, counts) ascending: the value standing for each bucket,
+        # within [min, max], and how many values it holds
+        keys = np.array(sorted(self.buckets), dtype='int64')
+        values = np.clip(2 * self.gamma ** keys.astype(float) / (self.gamma + 1), self.min, self.max)
+        counts = np.array([self.buckets[key] for key in keys.tolist()], dtype='int64')
+        if self.zeros:
+            values = np.r_[0.0, values]
+            counts = np.r_[self.zeros, counts]
+        return values, counts
+
+    def quantile(self, q):
+        # Quantiles with linear interpolation between order statistics, as
+        # pandas and numpy compute them by default; NaN for an empty sketch
+        q = np.asarray(q, dtype=float)
+        if not self.count:
+            return np.full(q.shape, np.nan)
+        values, counts = self.values()
+        position = q * (self.count - 1)
+        ranks = np.cumsum(counts)
+        lower = values[np.searchsorted(ranks, np.floor(position), side='right')]
+        upper = values[np.searchsorted(ranks, np.ceil(position), side='right')]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    def to_dict(self):
+        return {'alpha': self.alpha, 'count': self.count, 'sum': self.sum,
+                'min': self.min, 'max': self.max, 'zeros': self.zeros,
+                'keys': sorted(self.buckets), 'counts': [self.buckets[key] for key in sorted(self.buckets)]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['alpha'])
+        sketch.buckets = dict(zip(data['keys'], data['counts']))
+        sketch.zeros = data['zeros']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min'] if data['count'] else np.inf
+        sketch.max = data['max'] if data['count'] else -np.inf
+        return sketch
+
+
+def subject_sketches(tables, alpha=ALPHA):
+    # {sketch name: {subject: QuantileSketch}} of the SKETCHED columns of
+    # aggregate tables (those of aggregates.merge or subject_aggregates)
+    # and of the Bolus records in tables['bolus']
+    sketches = {}
+    for name, (table, column, positive) in SKETCHED.items():
+        sketches[name] = {}
+        df = tables.get(table)
+        if df is None or column not in df:
+            continue
+        values = schema.as_float(df[column])
+        subjects = df['subject'].to_numpy()
+        keep = values > 0 if positive else ~np.isnan(values)
+        for subject, subject_values in pd.Series(values[keep]).groupby(subjects[keep], sort=True):
+            sketches[name][int(subject)] = QuantileSketch(alpha).add(subject_values)
+    return sketches
+
+
+def merge_sketches(parts):
+    # One {sketch name: {subject: QuantileSketch}} from several, e.g. of
+    # disjoint sets of subjects or of the same subjects' separate records
+    merged = {name: {} for name in SKETCHED}
+    for sketches in parts:
+        for name, by_subject in sketches.items():
+            for subject, sketch in by_subject.items():
+                if subject in merged[name]:
+                    merged[name][subject].merge(sketch)
+                else:
+                    merged[name][subject] = QuantileSketch(sketch.alpha).merge(sketch)
+    return merged
+
+
+def sketch_table(sketches):
+    # {sketch name: {subject: QuantileSketch}} as a table of SKETCH_COLUMNS,
+    # which aggregate stores and partial files keep like any other table
+    rows = []
+    for name in SKETCHED:
+        for subject, sketch in sorted(sketches.get(name, {}).items()):
+            data = sketch.to_dict()
+            rows.append([name, subject] + [data[column] for column in SKETCH_COLUMNS[2:]])
+    return pd.DataFrame(rows, columns=SKETCH_COLUMNS)
+
+
+def table_sketches(table):
+    # sketch_table rows (possibly of several tables concatenated) back into
+    # {sketch name: {subject: QuantileSketch}}, subjects in order
+    sketches = {name: {} for name in SKETCHED}
+    for values in zip(*(table[column] for column in SKETCH_COLUMNS)):
+        row = dict(zip(SKETCH_COLUMNS, values))
+        sketches[row['sketch']][int(row['subject'])] = QuantileSketch.from_dict(
+            {'alpha': float(row['alpha']), 'count': int(row['count']), 'sum': float(row['sum']),
+             'min': float(row['min']), 'max': float(row['max']), 'zeros': int(row['zeros']),
+             'keys': [int(key) for key in row['keys']], 'counts': [int(count) for count in row['counts']]})
+    return {name: dict(sorted(by_subject.items())) for name, by_subject in sketches.items()}
+
+
+def cohort_sketch(by_subject, alpha=ALPHA):
+    # The sketch of every subject's values together
+    sketch = QuantileSketch(alpha)
+    for subject_sketch in by_subject.values():
+        sketch.merge(subject_sketch)
+    return sketch
+
+
+def box_stats(by_subject, whis=pump.WHISKER_IQR):
+    # pump.box_stats from sketches, ordered by subject; fliers are the
+    # bucket values outside the whiskers, once per value counted
+    stats = []
+    for subject in sorted(by_subject):
+        sketch = by_subject[subject]
+        if not sketch.count:
+            continue
+        q1, med, q3 = sketch.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        values, counts = sketch.values()
+        inside = (values >= q1 - whis * iqr) & (values <= q3 + whis * iqr)
+        stats.append({'label': subject,
+                      'med': med,
+                      'q1': q1,
+                      'q3': q3,
+                      'whislo': min(values[inside].min(), q1) if inside.any() else q1,
+                      'whishi': max(values[inside].max(), q3) if inside.any() else q3,
+                      'fliers': np.repeat(values[~inside], counts[~inside])})
+    return stats
+
+
+def histogram_values(sketches, columns):
+    # ({column: bucket values}, {column: counts}) of the cohort for each
+    # entry of columns ({column: sketch name}), for the plot_histograms
+    # functions, which weight each bucket value by its count
+    values, counts = {}, {}
+    for column, name in columns.items():
+        values[column], counts[column] = cohort_sketch(sketches[name]).values()
+    return values, counts
+
+
+def histogram(values, counts=None):
+    # (sns.histplot keyword arguments, mean) for a histogram of values. With
+    # counts, each value stands for that many: the histogram is weighted by
+    # them, with the bins numpy's 'auto' estimator (seaborn's default) picks
+    # for the values repeated counts times, so the bars are those of the
+    # expanded values without building them.
+    if counts is None:
+        return {}, np.nanmean(values)
+    values = np.asarray(values, dtype=float)
+    counts = np.asarray(counts, dtype='int64')
+    n = counts.sum()
+    if not n:
+        return {'weights': counts}, np.nan
+    order = np.argsort(values, kind='stable')
+    values, counts = values[order][counts[order] > 0], counts[order][counts[order] > 0]
+    first, last = values[0], values[-1]
+    # np.percentile([75, 25]) of the expanded values
+    position = np.array([0.75, 0.25]) * (n - 1)
+    ranks = np.cumsum(counts)
+    lower = values[np.searchsorted(ranks, np.floor(position), side='right')]
+    upper = values[np.searchsorted(ranks, np.ceil(position), side='right')]
+    q3, q1 = lower + (upper - lower) * (position - np.floor(position))
+    # numpy 2's 'auto' width: Freedman-Diaconis', at least half the square
+    # root rule's, or Sturges' if smaller
+    sturges = (last - first) / (np.log2(n) + 1.0)
+    fd = max(2.0 * (q3 - q1) * n ** (-1.0 / 3.0), (last - first) / np.sqrt(n) / 2)
+    width = min(fd, sturges)
+    if first == last:
+        first, last = first - 0.5, last + 0.5
+    bins = int(np.ceil((last - first) / width)) if width else 1
+    # seaborn refuses bins='auto' with weights, and compares the bins given
+    # to 'auto', which an array cannot be
+    return ({'weights': counts, 'bins': np.linspace(first, last, bins + 1).tolist()},
+            np.average(values, weights=counts))
+
+
+def write_sketches(sketches, path):
+    with open(path, 'w') as f:
+        json.dump({'version': VERSION,
+                   'sketches': {name: {str(subject): sketch.to_dict() for subject, sketch in by_subject.items()}
+                                for name, by_subject in sketches.items()}}, f)
+    print("Wrote " + path)
+
+
+def read_sketches(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != VERSION:
+        raise ValueError("{} holds sketches of version {}, expected {}".format(path, data.get('version'), VERSION))
+    return {name: {int(subject): QuantileSketch.from_dict(sketch) for subject, sketch in by_subject.items()}
+            for name, by_subject in data['sketches'].items()}
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+
+import json
+import numpy as np
+
+# Output for the scripts' --stats-only mode, which saves the aggregates a
+# figure is drawn from (CSV for tables, JSON otherwise) instead of drawing
+# it. The figure modules import matplotlib and seaborn inside their plotting
+# functions only, so a --stats-only run never loads the plotting stack.
+
+
+def json_value(value):
+    # JSON counterpart of the numpy scalars and arrays in aggregates
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot write {!r} as JSON".format(value))
+
+
+def write_table(df, path, index=False):
+    df.to_csv(path, index=index)
+    print('Wrote ' + path)
+
+
+def write_json(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, default=json_value)
+    print('Wrote ' + path)
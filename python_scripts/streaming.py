@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+import os
+import numpy as np
+import pandas as pd
+
+import aggregates
+import ingest
+import metrics
+import profiling
+import schema
+
+# Cohort aggregates computed one subject at a time instead of from the
+# concatenated cohort tables, so peak memory is bounded by one subject, or
+# by one chunk of its CGM readings when they come from an array directory
+# (see arrays.py). aggregate() returns the same tables as
+# AggregateStore.update (see aggregates.py).
+#
+# CGM readings go through running accumulators:
+#
+#   DailyMoments    count, mean and variance of the glucose of each
+#                   (subject, day), plus its in-range count and first and
+#                   last epoch. pandas computes a chunk's moments with
+#                   Welford's update; days spread over several chunks are
+#                   combined with the parallel form (Chan et al.).
+#   RangeCounter    running reading counts per glucose range and subject
+#
+# whole_days() holds back each chunk's trailing day for the next chunk, so
+# a day whose readings are contiguous (every day of a workbook sheet) is
+# never split and its metrics are identical to metrics.daily_metrics.
+# Bolus records are a small fraction of the data and are aggregated per
+# subject as a whole.
+
+CHUNK_ROWS = 1 << 16
+MOMENT_COLUMNS = ['size', 'count', 'mean', 'var', 'in_range', 'first', 'last']
+
+
+def whole_days(chunks):
+    # chunks of canonical CGM rows, re-cut so that no day with contiguous
+    # readings is split between two of them
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        days = chunk['day'].to_numpy()
+        cut = len(days)
+        while cut and days[cut - 1] == days[-1]:
+            cut -= 1
+        carry = chunk.iloc[cut:]
+        if cut:
+            yield chunk.iloc[:cut]
+    if carry is not None and len(carry):
+        yield carry
+
+
+class DailyMoments:
+
+    def __init__(self, target_range=metrics.TARGET_RANGE):
+        self.target_range = target_range
+        self.parts = []
+
+    def add(self, cbg_df):
+        glucose = schema.as_float(cbg_df['mg/dl'])
+        in_range = (glucose >= self.target_range[0]) & (glucose <= self.target_range[1])
+        grouped = pd.DataFrame({'subject': cbg_df['subject'].values,
+                                'day': cbg_df['day'].values,
+                                'epoch': cbg_df['epoch'].values,
+                                'mg/dl': glucose,
+                                'in_range': in_range})
+        grouped = grouped.groupby(['subject', 'day'], sort=False)
+        part = grouped['mg/dl'].agg(['size', 'count', 'mean', 'var'])
+        part['in_range'] = grouped['in_range'].sum()
+        part['first'] = grouped['epoch'].min()
+        part['last'] = grouped['epoch'].max()
+        self.parts.append(part)
+
+    def moments(self):
+        # One row per (subject, day) in order of first appearance with the
+        # columns MOMENT_COLUMNS; var is the sample variance (NaN below two
+        # readings)
+        parts = pd.concat(self.parts)
+        split = parts.index.duplicated(keep=False)
+        if not split.any():
+            return parts
+        order = parts.index[~parts.index.duplicated()]
+        return pd.concat([parts[~split], combine_moments(parts[split])]).reindex(order)
+
+    def daily_metrics(self, min_readings=metrics.MIN_DAILY_READINGS,
+                      readings_per_day=metrics.READINGS_PER_DAY):
+        moments = self.moments()
+        daily = pd.DataFrame({'readings': moments['size'],
+                              'mean': moments['mean'],
+                              'std': np.sqrt(moments['var']),
+                              'in_range': moments['in_range']})
+        return metrics.daily_metrics_from(daily, min_readings, readings_per_day)
+
+    def coverage(self, min_readings=metrics.MIN_DAILY_READINGS):
+        # The CGM columns of metrics.cohort_summary
+        moments = self.moments()
+        grouped = moments.groupby(level='subject', sort=False)
+        coverage = pd.DataFrame({'readings': grouped['size'].sum(),
+                                 'cgm_days': (moments['size'] > min_readings).groupby(level='subject', sort=False).sum(),
+                                 'first_reading': grouped['first'].min(),
+                                 'last_reading': grouped['last'].max()})
+        coverage.index.name = 'subject'
+        return coverage
+
+
+def combine_moments(parts):
+    # Moments of the union of the readings behind several rows per key
+    grouped = parts.groupby(level=[0, 1], sort=False)
+    n = parts['count'].to_numpy(dtype=float)
+    means = parts['mean'].fillna(0).to_numpy()
+    count = grouped['count'].sum()
+    mean = pd.Series(n * means, index=parts.index).groupby(level=[0, 1], sort=False).sum() / count
+    deviation = means - mean.reindex(parts.index).to_numpy()
+    m2 = parts['var'].fillna(0).to_numpy() * np.maximum(n - 1, 0) + n * deviation ** 2
+    m2 = pd.Series(m2, index=parts.index).groupby(level=[0, 1], sort=False).sum()
+
+    combined = pd.DataFrame({'size': grouped['size'].sum(),
+                             'count': count,
+                             'mean': mean,
+                             'var': (m2 / (count - 1)).where(count > 1),
+                             'in_range': grouped['in_range'].sum(),
+                             'first': grouped['first'].min(),
+                             'last': grouped['last'].max()})
+    return combined[MOMENT_COLUMNS]
+
+
+class RangeCounter:
+
+    def __init__(self, edges=metrics.RANGE_EDGES):
+        self.edges = edges
+        self.counts = None
+
+    def add(self, cbg_df):
+        counts = metrics.range_counts(cbg_df, self.edges)
+        if self.counts is None:
+            self.counts = counts
+        else:
+            self.counts = self.counts.add(counts, fill_value=0).astype(counts.dtypes)
+
+
+def subject_aggregates(cgm_chunks, bolus_df):
+    # aggregates.subject_aggregates of one subject whose CGM readings come as
+    # an iterable of chunks
+    with profiling.stage('aggregate') as record:
+        moments = DailyMoments()
+        ranges = RangeCounter()
+        for chunk in whole_days(chunk for chunk in cgm_chunks if chunk is not None and len(chunk)):
+            moments.add(chunk)
+            ranges.add(chunk)
+
+        tables = aggregates.subject_aggregates(None, bolus_df)
+        if moments.parts:
+            tables['daily_metrics'] = moments.daily_metrics()
+            tables['range_counts'] = ranges.counts
+            coverage = moments.coverage()
+            if 'coverage' in tables:
+                coverage = pd.concat([coverage, tables['coverage']], axis=1)
+                coverage.index.name = 'subject'
+            tables['coverage'] = coverage
+            tables['sketches'] = aggregates.sketch_table(tables, bolus_df)
+        if 'coverage' in tables:
+            record['subject'] = int(tables['coverage'].index[0])
+        record['rows'] = sum(len(df) for df in tables.values())
+    return tables
+
+
+def workbook_subjects(dataset_path, files=None):
+    # (CGM chunks, Bolus table) of each workbook (of files, by default every
+    # file in dataset_path), read one at a time
+    for file in os.listdir(dataset_path) if files is None else files:
+        frames, counts = ingest.load_subject(dataset_path, file, aggregates.SHEETS)
+        yield [frames['CGM']], frames['Bolus']
+
+
+def array_subjects(store, chunk_rows=CHUNK_ROWS):
+    # (CGM chunks, Bolus table) of each subject of an arrays.ArrayStore,
+    # the CGM readings memory-mapped chunk_rows at a time
+    for subject in store.subjects():
+        yield store.chunks(subject, 'CGM', chunk_rows), store.table(subject, 'Bolus')
+
+
+def aggregate(subjects):
+    # The merged cohort tables (see aggregates.merge) from an iterable of
+    # (CGM chunks, Bolus table) pairs such as workbook_subjects()
+    return aggregates.merge([subject_aggregates(cgm_chunks, bolus_df) for cgm_chunks, bolus_df in subjects])
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+import sys, getopt
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Synthetic SubjectNN.xlsx workbooks shaped like DiaTrend's, for testing and
+# benchmarking beyond the real cohort:
+#
+#   CGM     date, mg/dl                                 a reading every 5 minutes
+#                                                       with sensor gaps
+#   Bolus   date, normal, carbInput, insulinCarbRatio   meal and correction
+#                                                       boluses
+#   Basal   date, duration, rate                        the subject's daily rate
+#                                                       schedule
+#
+# Rows are newest first, as in the dataset. Glucose follows a subject-level
+# baseline with slow noise and a rise after every meal, and a few readings
+# are repeated, as the sensor exports sometimes do. Every subject has its
+# own random schedule of meals, insulin to carb ratios and basal rates, and
+# a collection period that includes FIGURE1_DAY, the day Figure 1 draws by
+# default. As for many real subjects, the pump records start
+# PUMP_START_DAYS after the CGM readings, so the first days have glucose but
+# no bolus or basal record before them (dailyviews.py must draw those too).
+
+READING_MINUTES = 5
+GLUCOSE_RANGE = (40, 400)
+MEALS = [(7.5, 1.0, 45), (12.5, 1.0, 60), (18.5, 1.0, 70)]    # hour, spread (h), mean carbs (g)
+SNACKS_PER_DAY = 1.0
+CORRECTIONS_PER_DAY = 1.5
+DUPLICATE_FRACTION = 0.001
+FIGURE1_DAY = pd.Timestamp('2021-05-20')    # Thursday of week 20
+PUMP_START_DAYS = 2
+
+
+def meal_times(rng, days):
+    # Minutes since the first midnight of every meal and snack, and its carbs
+    minutes = []
+    carbs = []
+    for hour, spread, mean_carbs in MEALS:
+        eaten = rng.random(days) > 0.1
+        minutes.append((np.arange(days)[eaten] * 24 + rng.normal(hour, spread / 2, eaten.sum())) * 60)
+        carbs.append(rng.gamma(4, mean_carbs / 4, eaten.sum()))
+    snacks = rng.poisson(SNACKS_PER_DAY * days)
+    minutes.append(rng.uniform(0, days * 24 * 60, snacks))
+    carbs.append(rng.gamma(2, 10, snacks))
+    minutes = np.concatenate(minutes).clip(0, days * 24 * 60 - 1)
+    carbs = np.concatenate(carbs).round().clip(1, 200)
+    order = np.argsort(minutes)
+    return minutes[order].astype('int64'), carbs[order]
+
+
+def cgm_sheet(rng, start, days, meals, carbs):
+    minutes = np.arange(0, days * 24 * 60, READING_MINUTES)
+    baseline = rng.uniform(100, 150)
+    noise = np.cumsum(rng.normal(0, 2, len(minutes)))
+    noise -= pd.Series(noise).rolling(72, min_periods=1).mean().to_numpy()
+
+    # A meal raises glucose by about 1.5 mg/dL per gram, peaking after an
+    # hour and fading over three
+    response = np.zeros(len(minutes))
+    step = np.arange(0, 240, READING_MINUTES)
+    shape = (step / 60) * np.exp(1 - step / 60)
+    for minute, grams in zip(meals, carbs):
+        first = minute // READING_MINUTES
+        end = min(first + len(shape), len(minutes))
+        response[first:end] += 1.5 * grams * shape[:end - first]
+    glucose = (baseline + 35 * noise / (noise.std() or 1) + response * rng.uniform(0.6, 1.2)).round()
+    glucose = glucose.clip(*GLUCOSE_RANGE).astype('int64')
+
+    # Sensor gaps: a two hour warm-up every ten days and random dropouts
+    kept = np.ones(len(minutes), dtype=bool)
+    warm_ups = np.arange(0, days, 10) * 24 * 60
+    dropouts = rng.uniform(0, days * 24 * 60, rng.poisson(days / 5))
+    gap_starts = np.r_[warm_ups, dropouts]
+    gap_lengths = np.r_[np.full(len(warm_ups), 120), rng.uniform(15, 360, len(dropouts))]
+    for gap_start, gap_length in zip(gap_starts, gap_lengths):
+        kept &= (minutes < gap_start) | (minutes >= gap_start + gap_length)
+    minutes, glucose = minutes[kept], glucose[kept]
+
+    repeated = rng.random(len(minutes)) < DUPLICATE_FRACTION
+    minutes = np.r_[minutes, minutes[repeated]]
+    glucose = np.r_[glucose, glucose[repeated]]
+    order = np.argsort(-minutes, kind='stable')
+    return pd.DataFrame({'date': start + pd.to_timedelta(minutes[order], unit='min'),
+                         'mg/dl': glucose[order]})
+
+
+def bolus_sheet(rng, start, days, meals, carbs):
+    # Carb ratios change at fixed hours of the day; a meal bolus covers the
+    # carbs at the ratio in effect, plus a correction now and then
+    ratio_hours = np.array([0, 11, 17])
+    ratios = rng.choice([8, 10, 12, 15, 18], len(ratio_hours))
+    corrections = np.sort(rng.uniform(0, days * 24 * 60, rng.poisson(CORRECTIONS_PER_DAY * days))).astype('int64')
+    minutes = np.r_[meals, corrections]
+    carb_input = np.r_[carbs, np.zeros(len(corrections))].astype('int64')
+    ratio = ratios[np.searchsorted(ratio_hours, (minutes // 60) % 24, side='right') - 1]
+    normal = carb_input / ratio + np.where(rng.random(len(minutes)) < 0.3, rng.uniform(0.1, 2, len(minutes)), 0)
+    normal = np.where(carb_input > 0, normal, rng.uniform(0.05, 2, len(minutes))).round(2)
+    order = np.argsort(-minutes, kind='stable')
+    order = order[minutes[order] >= PUMP_START_DAYS * 24 * 60]
+    return pd.DataFrame({'date': start + pd.to_timedelta(minutes[order], unit='min'),
+                         'normal': normal[order],
+                         'carbInput': carb_input[order],
+                         'insulinCarbRatio': ratio[order]})
+
+
+def basal_sheet(rng, start, days):
+    # A schedule of 3 to 6 rates a day, each record lasting until the next
+    hours = np.sort(np.r_[0, rng.choice(np.arange(1, 24, 0.25), rng.integers(2, 6), replace=False)])
+    rates = rng.uniform(0.3, 1.5, len(hours)).round(2)
+    minutes = (np.arange(days)[:, None] * 24 * 60 + hours[None, :] * 60).ravel().astype('int64')
+    rate = np.tile(rates, days)
+    duration = np.diff(np.r_[minutes, days * 24 * 60]) * 60000
+    order = np.argsort(-minutes, kind='stable')
+    order = order[minutes[order] >= PUMP_START_DAYS * 24 * 60]
+    return pd.DataFrame({'date': start + pd.to_timedelta(minutes[order], unit='min'),
+                         'duration': duration[order],
+                         'rate': rate[order]})
+
+
+def write_workbook(path, rng, days):
+    # FIGURE1_DAY falls after the pump records start
+    start = FIGURE1_DAY - pd.Timedelta(days=int(rng.integers(min(PUMP_START_DAYS, days - 1), days)))
+    meals, carbs = meal_times(rng, days)
+    with pd.ExcelWriter(path) as writer:
+        cgm_sheet(rng, start, days, meals, carbs).to_excel(writer, sheet_name='CGM', index=False)
+        bolus_sheet(rng, start, days, meals, carbs).to_excel(writer, sheet_name='Bolus', index=False)
+        basal_sheet(rng, start, days).to_excel(writer, sheet_name='Basal', index=False)
+
+
+def generate(dataset_path, subjects, days=60, templates=None, seed=0):
+    # Writes Subject1.xlsx to Subject<subjects>.xlsx. With templates, only
+    # that many distinct workbooks are generated and the other subjects are
+    # hard links (or copies) of them, which keeps large cohorts quick to
+    # create; subject numbers come from the file names, so each is still a
+    # separate subject.
+    os.makedirs(dataset_path, exist_ok=True)
+    templates = subjects if templates is None else min(templates, subjects)
+    for subject in range(1, subjects + 1):
+        path = os.path.join(dataset_path, 'Subject{}.xlsx'.format(subject))
+        if os.path.exists(path):
+            os.remove(path)
+        if subject <= templates:
+            write_workbook(path, np.random.default_rng([seed, subject]), days)
+            continue
+        template = os.path.join(dataset_path, 'Subject{}.xlsx'.format((subject - 1) % templates + 1))
+        try:
+            os.link(template, path)
+        except OSError:
+            shutil.copyfile(template, path)
+
+
+def main(argv):
+    datadir_path = ''
+    subjects = 54
+    days = 60
+    templates = None
+    seed = 0
+
+    usage = 'synthetic.py -o <path to dataset directory> [-n <number of subjects>] [-d <days per subject>] [-t <distinct workbooks>] [--seed <seed>]'
+    if (len(argv) < 2):
+        print("Incorrent number of arguments: " + str(len(argv)))
+        print(usage)
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(argv,"ho:n:d:t:",["datasetDir=","subjects=","days=","templates=","seed="])
+    except getopt.GetoptError:
+        print('GetoptError:\t ' + usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('Example:\t synthetic.py -o ../synthetic/ -n 500 -d 90 -t 54')
+            sys.exit()
+        elif opt in ("-o", "--datasetDir"):
+            datadir_path = arg
+        elif opt in ("-n", "--subjects"):
+            subjects = int(arg)
+        elif opt in ("-d", "--days"):
+            days = int(arg)
+        elif opt in ("-t", "--templates"):
+            templates = int(arg)
+        elif opt == "--seed":
+            seed = int(arg)
+        else:
+            print(usage)
+
+    print('Path to dataset directory is ' + datadir_path)
+    generate(datadir_path, subjects, days, templates, seed)
+    print("Wrote {} subjects of {} days".format(subjects, days))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
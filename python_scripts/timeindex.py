@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+
+class TimeIndex:
+    # Canonical tables (see schema.py) of several streams, e.g.
+    # {'CGM': cgm_df, 'Bolus': bolus_df, 'Basal': basal_df}, each sorted once
+    # by (subject, epoch) with every subject's row range recorded. A window
+    # query is then two binary searches per stream over that subject's
+    # epochs, whatever the size of the cohort.
+
+    def __init__(self, streams):
+        self.tables = {}
+        self.epochs = {}
+        self.bounds = {}
+        for name, df in streams.items():
+            if 'subject' not in df:
+                # Sheet missing from every workbook
+                df = pd.DataFrame({'subject': np.array([], dtype=schema.SUBJECT_DTYPE),
+                                   'epoch': np.array([], dtype='int64')})
+            subjects = df['subject'].to_numpy()
+            epochs = df['epoch'].to_numpy()
+            order = np.lexsort((epochs, subjects))
+            subjects = subjects[order]
+            starts = np.flatnonzero(subjects[1:] != subjects[:-1]) + 1
+            if len(subjects):
+                starts = np.r_[0, starts]
+            ends = np.r_[starts[1:], len(subjects)]
+            self.tables[name] = df.iloc[order]
+            self.epochs[name] = epochs[order]
+            self.bounds[name] = {int(subjects[start]): (start, end) for start, end in zip(starts, ends)}
+
+    def subjects(self):
+        return sorted(set().union(*[bounds.keys() for bounds in self.bounds.values()]))
+
+    def span(self, subject, name=None):
+        # (first, last) epoch of the subject's records in stream name, or in
+        # any stream; None when there are none
+        names = [name] if name is not None else list(self.tables)
+        spans = [(self.epochs[n][self.bounds[n][subject][0]], self.epochs[n][self.bounds[n][subject][1] - 1])
+                 for n in names if subject in self.bounds[n]]
+        if not spans:
+            return None
+        return int(min(s[0] for s in spans)), int(max(s[1] for s in spans))
+
+    def window(self, subject, start, end):
+        # {stream name: the subject's records with start <= epoch < end,
+        # oldest first}; start and end are epoch seconds
+        streams = {}
+        for name, table in self.tables.items():
+            lo, hi = self.bounds[name].get(subject, (0, 0))
+            epochs = self.epochs[name][lo:hi]
+            first = lo + np.searchsorted(epochs, start, side='left')
+            last = lo + np.searchsorted(epochs, end, side='left')
+            streams[name] = table.iloc[first:last]
+        return streams
+
+    def last_before(self, subject, name, epoch):
+        # The subject's last record in stream name before epoch, or None
+        lo, hi = self.bounds[name].get(subject, (0, 0))
+        i = lo + np.searchsorted(self.epochs[name][lo:hi], epoch, side='left')
+        if i == lo:
+            return None
+        return self.tables[name].iloc[i - 1]
+
+    def day(self, subject, day, days=1):
+        # window() over whole days, day being a day number (see schema.py)
+        return self.window(subject, day * schema.SECONDS_PER_DAY, (day + days) * schema.SECONDS_PER_DAY)
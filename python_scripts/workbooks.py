@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow.parquet
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
+# Parsed sheets are cached as Parquet under DIATREND_CACHE_DIR (default
+# ~/.cache/diatrend). Set DIATREND_CACHE_DIR=off to always decode the XLSX.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diatrend')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SheetCache:
+    # One directory per workbook (named after a hash of its absolute path)
+    # holding meta.json and one <sheet>.parquet per parsed sheet:
+    #
+    #   <cache_dir>/<path hash>/meta.json      {path, size, mtime_ns, sha1}
+    #   <cache_dir>/<path hash>/CGM.parquet
+    #
+    # Entries are valid while the workbook's size and mtime are unchanged.
+    # If either changes the content hash is recomputed; a different hash
+    # drops every sheet cached for that workbook. Whole workbook directories
+    # are evicted least-recently-used first once max_bytes is exceeded.
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get('DIATREND_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('DIATREND_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = HAVE_PARQUET and cache_dir not in ('', 'off')
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_dir(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.cache_dir, key)
+
+    def _sheet_file(self, entry_dir, sheet_name):
+        return os.path.join(entry_dir, sheet_name + '.parquet')
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, entry_dir, meta):
+        tmp = os.path.join(entry_dir, 'meta.json.%d' % os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(entry_dir, 'meta.json'))
+
+    def _ensure_meta(self, entry_dir, path):
+        meta = self._read_meta(entry_dir)
+        if meta is None:
+            st = os.stat(path)
+            meta = {'path': os.path.abspath(path),
+                    'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns,
+                    'sha1': file_sha1(path)}
+            self._write_meta(entry_dir, meta)
+        return meta
+
+    def _validate(self, path):
+        # Returns the entry directory if its cached sheets still describe the
+        # workbook at path, clearing it first when the workbook has changed.
+        entry_dir = self._entry_dir(path)
+        meta = self._read_meta(entry_dir)
+        st = os.stat(path)
+        if meta is None:
+            return entry_dir, None
+        if meta['size'] == st.st_size and meta['mtime_ns'] == st.st_mtime_ns:
+            return entry_dir, meta
+        sha1 = file_sha1(path)
+        if sha1 == meta['sha1']:
+            meta['size'] = st.st_size
+            meta['mtime_ns'] = st.st_mtime_ns
+            self._write_meta(entry_dir, meta)
+            return entry_dir, meta
+        self.invalidate(path)
+        return entry_dir, None
+
+    def get(self, path, sheet_name, columns=None):
+        if not self.enabled:
+            return None
+        try:
+            entry_dir, meta = self._validate(path)
+            if meta is None:
+                self.misses += 1
+                return None
+            sheet_file = self._sheet_file(entry_dir, sheet_name)
+            if columns is not None:
+                names = pyarrow.parquet.read_schema(sheet_file).names
+                columns = [c for c in columns if c in names]
+            df = pd.read_parquet(sheet_file, columns=columns)
+            os.utime(entry_dir)
+        except Exception:
+            # Sheet never cached, evicted meanwhile, or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return df
+
+    def put(self, path, sheet_name, df):
+        if not self.enabled:
+            return
+        entry_dir = self._entry_dir(path)
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            self._ensure_meta(entry_dir, path)
+            sheet_file = self._sheet_file(entry_dir, sheet_name)
+            tmp = sheet_file + '.%d' % os.getpid()
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, sheet_file)
+        except Exception:
+            # Sheets pyarrow cannot represent (e.g. mixed-type object columns)
+            # are simply not cached.
+            return
+        if self.total_bytes is not None:
+            self.total_bytes += os.path.getsize(sheet_file)
+        self.evict()
+
+    def sheet_names(self, path):
+        # Sheet names recorded for an unchanged workbook, or None if unknown
+        if not self.enabled:
+            return None
+        try:
+            entry_dir, meta = self._validate(path)
+        except OSError:
+            return None
+        if meta is None:
+            return None
+        return meta.get('sheet_names')
+
+    def put_sheet_names(self, path, sheet_names):
+        if not self.enabled:
+            return
+        entry_dir = self._entry_dir(path)
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            meta = self._ensure_meta(entry_dir, path)
+            meta['sheet_names'] = list(sheet_names)
+            self._write_meta(entry_dir, meta)
+        except OSError:
+            pass
+
+    def invalidate(self, path):
+        shutil.rmtree(self._entry_dir(path), ignore_errors=True)
+        self.total_bytes = None
+
+    def entries(self):
+        # (last used, bytes, directory) for every cached workbook
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for f in os.listdir(entry_dir):
+                try:
+                    size += os.path.getsize(os.path.join(entry_dir, f))
+                except OSError:
+                    pass
+            try:
+                entries.append((os.stat(entry_dir).st_mtime_ns, size, entry_dir))
+            except OSError:
+                pass
+        return entries
+
+    def evict(self):
+        if self.total_bytes is None:
+            self.total_bytes = sum(e[1] for e in self.entries())
+        if self.total_bytes <= self.max_bytes:
+            return
+        entries = sorted(self.entries())
+        self.total_bytes = sum(e[1] for e in entries)
+        for last_used, size, entry_dir in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self.total_bytes -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.total_bytes = None
+
+
+def project(df, columns):
+    # Keep the requested columns a sheet actually has; absent ones are left
+    # for pd.concat to fill with NaN, as when workbooks differ in layout.
+    if columns is None:
+        return df
+    return df[[c for c in columns if c in df.columns]]
+
+
+def read_sheets(path, sheets, cache=None):
+    # Read several sheets of one workbook, opening and decompressing the XLSX
+    # at most once. sheets maps each sheet name to the columns the caller
+    # uses (None for all of them). Returns {sheet name: frame}; sheets the
+    # workbook does not have are left out.
+    if cache is None:
+        cache = SheetCache()
+    frames = {}
+    missing = []
+    sheet_names = cache.sheet_names(path)
+    for sheet_name, columns in sheets.items():
+        if sheet_names is not None and sheet_name not in sheet_names:
+            continue
+        df = cache.get(path, sheet_name, columns)
+        if df is None:
+            missing.append(sheet_name)
+        else:
+            frames[sheet_name] = df
+
+    if missing:
+        with pd.ExcelFile(path) as xlsx:
+            cache.put_sheet_names(path, xlsx.sheet_names)
+            for sheet_name in missing:
+                if sheet_name not in xlsx.sheet_names:
+                    continue
+                columns = sheets[sheet_name]
+                if cache.enabled:
+                    # Cache the whole sheet so other column projections hit
+                    df = xlsx.parse(sheet_name)
+                    cache.put(path, sheet_name, df)
+                    df = project(df, columns)
+                else:
+                    usecols = None if columns is None else (lambda c: c in columns)
+                    df = project(xlsx.parse(sheet_name, usecols=usecols), columns)
+                frames[sheet_name] = df
+    return frames
+
+
+def read_sheet(path, sheet_name, cache=None, columns=None):
+    # Drop-in replacement for pd.read_excel(path, sheet_name=...) that serves
+    # the parsed sheet from the on-disk cache when the workbook is unchanged.
+    frames = read_sheets(path, {sheet_name: columns}, cache)
+    if sheet_name not in frames:
+        raise ValueError("Worksheet named '%s' not found" % sheet_name)
+    return frames[sheet_name]